@@ -0,0 +1,209 @@
+import asyncio, collections, struct
+from tracing import TX, RX
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+class AsyncModbusClient:
+
+    def __init__(self, host, port, unit_id = 1, timeout = 1.0, max_in_flight = 4, verbose = False, tracer = None,
+                 max_pipelining_failures = 3, pipelining_retry_after = 600.0):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.verbose = verbose
+        self.tracer = tracer
+
+        # max_in_flight = 1 sends one request at a time, for gateways that cannot pipeline
+        self.max_in_flight = max_in_flight
+        self.configured_max_in_flight = max_in_flight
+        self.in_flight = 0
+
+        # pipelining is given up after max_pipelining_failures dropped pipelined requests or replies with unknown
+        # transaction ids in a row, and tried again on reconnect or after pipelining_retry_after seconds
+        self.max_pipelining_failures = max_pipelining_failures
+        self.pipelining_retry_after = pipelining_retry_after
+        self.pipelining_failures = 0
+        self.pipelining_retry_time = None
+        self.num_replies = 0
+        self.replies_at_failure = None
+
+        # late replies to timed-out transactions are expected and dropped
+        self.expired_ids = collections.deque(maxlen = 32)
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending = {}
+        self.transaction_id = 0
+
+        self.slot_available = None
+        self.connect_lock = None
+
+    def is_connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+
+        # synchronisation primitives are created lazily so that they bind to the running loop
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+            self.slot_available = asyncio.Condition()
+
+        async with self.connect_lock:
+            if self.is_connected():
+                return
+
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            self.expired_ids.clear()
+            self.restore_pipelining()
+            self.reader_task = asyncio.ensure_future(self._read_loop(self.reader))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+
+        self._fail_pending(ConnectionError("Error: connection closed"))
+
+    def disable_pipelining(self):
+        if self.max_in_flight > 1:
+            if self.verbose:
+                print(f"Modbus gateway {self.host}:{self.port} does not pipeline, falling back to one request at a time.")
+            self.max_in_flight = 1
+            self.pipelining_retry_time = asyncio.get_running_loop().time() + self.pipelining_retry_after
+
+    def restore_pipelining(self):
+        self.max_in_flight = self.configured_max_in_flight
+        self.pipelining_failures = 0
+        self.pipelining_retry_time = None
+
+    def _pipelining_failed(self):
+        self.pipelining_failures += 1
+        if self.pipelining_failures >= self.max_pipelining_failures:
+            self.disable_pipelining()
+
+    async def read_holding_registers(self, addr, num_words):
+        if not 1 <= num_words <= 125:
+            raise ValueError("num_words out of range (valid from 1 to 125)")
+
+        rx_pdu = await self._request(struct.pack(">BHH", READ_HOLDING_REGISTERS, addr, num_words))
+
+        byte_count = rx_pdu[1]
+        if byte_count != 2 * num_words or len(rx_pdu) != 2 + byte_count:
+            raise ConnectionError("Error: rx byte count mismatch")
+
+        return list(struct.unpack(">{}H".format(num_words), rx_pdu[2:]))
+
+    async def write_multiple_registers(self, addr, words):
+        if not 1 <= len(words) <= 123:
+            raise ValueError("Number of words out of range (valid from 1 to 123)")
+
+        tx_pdu = struct.pack(">BHHB{}H".format(len(words)), WRITE_MULTIPLE_REGISTERS, addr, len(words), 2 * len(words), *words)
+        rx_pdu = await self._request(tx_pdu)
+
+        resp_addr, resp_num_words = struct.unpack(">HH", rx_pdu[1:5])
+        return resp_addr == addr and resp_num_words == len(words)
+
+    def _next_transaction_id(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        return self.transaction_id
+
+    async def _acquire_slot(self):
+        async with self.slot_available:
+            await self.slot_available.wait_for(lambda: self.in_flight < self.max_in_flight)
+            self.in_flight += 1
+
+    async def _release_slot(self):
+        async with self.slot_available:
+            self.in_flight -= 1
+            self.slot_available.notify_all()
+
+    async def _request(self, tx_pdu):
+        await self.connect()
+
+        if self.pipelining_retry_time is not None and asyncio.get_running_loop().time() >= self.pipelining_retry_time:
+            self.restore_pipelining()
+
+        # the deadline covers waiting for a free slot as well as the transaction itself
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        await asyncio.wait_for(self._acquire_slot(), self.timeout)
+
+        try:
+            transaction_id = self._next_transaction_id()
+            future = asyncio.get_running_loop().create_future()
+
+            # an answer proves pipelining only if another request was outstanding when this one went out
+            pipelined = len(self.pending) > 0
+            self.pending[transaction_id] = future
+            replies_before = self.num_replies
+            tx_frame = struct.pack(">HHHB", transaction_id, 0, len(tx_pdu) + 1, self.unit_id) + tx_pdu
+            if self.tracer is not None:
+                self.tracer.record(TX, tx_frame)
+            self.writer.write(tx_frame)
+
+            try:
+                remaining = max(deadline - asyncio.get_running_loop().time(), 0.0)
+                rx_pdu = await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                self.pending.pop(transaction_id, None)
+                self.expired_ids.append(transaction_id)
+                # the request was dropped if the gateway kept answering meanwhile; a stall that times out
+                # several requests at once counts as one failure
+                if pipelined and self.num_replies > replies_before and self.num_replies != self.replies_at_failure:
+                    self.replies_at_failure = self.num_replies
+                    self._pipelining_failed()
+                raise TimeoutError(f"Error: no response to transaction {transaction_id}")
+        finally:
+            await self._release_slot()
+
+        if pipelined:
+            self.pipelining_failures = 0
+
+        if rx_pdu[0] == tx_pdu[0] | 0x80:
+            raise RuntimeError(f"Error: modbus exception {rx_pdu[1]}")
+        if rx_pdu[0] != tx_pdu[0]:
+            raise ConnectionError("Error: unexpected function code in response")
+
+        return rx_pdu
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit_id = struct.unpack(">HHHB", header)
+                rx_pdu = await reader.readexactly(length - 1)
+                if self.tracer is not None:
+                    self.tracer.record(RX, header + rx_pdu)
+
+                future = self.pending.pop(transaction_id, None)
+                if future is None:
+                    if transaction_id in self.expired_ids:
+                        # late reply to a request that timed out: slow, but nothing was dropped
+                        self.expired_ids.remove(transaction_id)
+                        self.pipelining_failures = 0
+                    else:
+                        # foreign transaction id: the gateway may not keep pipelined requests apart
+                        self._pipelining_failed()
+                    continue
+
+                self.num_replies += 1
+                if not future.done():
+                    future.set_result(rx_pdu)
+
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self._fail_pending(ConnectionError("Error: connection lost"))
+
+    def _fail_pending(self, exc):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
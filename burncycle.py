@@ -0,0 +1,160 @@
+import argparse, time
+
+# heat capacity of water: 4.186 kJ / (kg K), with 1 l ~ 1 kg
+WATER_kWh_PER_l_K = 4.186 / 3600.0
+
+class BurnCycleAnalyser:
+
+    def __init__(self, start_exhaust_temp = 80.0, end_exhaust_temp = 60.0, min_duration = 600.0,
+                 o2_band = (4.0, 8.0), buffer_volume_l = 2000.0, max_gap = 60.0):
+        if not end_exhaust_temp < start_exhaust_temp:
+            raise ValueError("Need end_exhaust_temp < start_exhaust_temp")
+
+        # a burn starts once the exhaust temperature exceeds start_exhaust_temp and ends when it drops
+        # below end_exhaust_temp; shorter burns than min_duration (seconds) are not reported
+        self.start_exhaust_temp = start_exhaust_temp
+        self.end_exhaust_temp = end_exhaust_temp
+        self.min_duration = min_duration
+
+        # residual oxygen range (%) counted as good combustion
+        self.o2_low, self.o2_high = o2_band
+        self.buffer_kWh_per_K = buffer_volume_l * WATER_kWh_PER_l_K
+
+        # samples hold their values until the next one; longer intervals than max_gap (e.g. while the
+        # boiler was unreachable) are left out of the averages
+        self.max_gap = max_gap
+
+        self.burning = False
+        self.num_burns = 0
+        self.last_time = None
+        self.last_sample = None
+
+    def update(self, values, timestamp = None):
+        # takes the decoded parameter values, returns the summary of a burn that just ended (or None);
+        # constant work and memory per sample
+        timestamp = time.time() if timestamp is None else timestamp
+
+        exhaust_temp = values.get("Abgastemp.")
+        if exhaust_temp is None:
+            return None
+
+        sample = (exhaust_temp, values.get("Rest-O2", 0.0), values.get("Prim.Luft", 0.0), values.get("Sek.Luft", 0.0))
+        buffer_temps = (values.get("Puffert.ob"), values.get("Puffert.mi"), values.get("Puffert.un"))
+        buffer_temp = None if None in buffer_temps else sum(buffer_temps) / 3.0
+
+        if self.burning:
+            dt = timestamp - self.last_time
+            if 0 < dt <= self.max_gap:
+                last_exhaust_temp, last_o2, last_primary_air, last_secondary_air = self.last_sample
+                self.covered += dt
+                self.o2_integral += last_o2 * dt
+                self.primary_air_integral += last_primary_air * dt
+                self.secondary_air_integral += last_secondary_air * dt
+                if self.o2_low <= last_o2 <= self.o2_high:
+                    self.good_combustion += dt
+
+            self.peak_exhaust_temp = max(self.peak_exhaust_temp, exhaust_temp)
+            if buffer_temp is not None:
+                if self.buffer_temp_start is None:
+                    self.buffer_temp_start = buffer_temp
+                self.buffer_temp_end = buffer_temp
+                self.buffer_temp_peak = max(self.buffer_temp_peak, buffer_temp)
+
+        summary = None
+        if not self.burning and exhaust_temp >= self.start_exhaust_temp:
+            self._start_burn(timestamp, exhaust_temp, buffer_temp)
+        elif self.burning and exhaust_temp < self.end_exhaust_temp:
+            summary = self._end_burn(timestamp)
+
+        self.last_time = timestamp
+        self.last_sample = sample
+        return summary
+
+    def _start_burn(self, timestamp, exhaust_temp, buffer_temp):
+        self.burning = True
+        self.start_time = timestamp
+        self.covered = 0.0
+        self.o2_integral = 0.0
+        self.primary_air_integral = 0.0
+        self.secondary_air_integral = 0.0
+        self.good_combustion = 0.0
+        self.peak_exhaust_temp = exhaust_temp
+        self.buffer_temp_start = buffer_temp
+        self.buffer_temp_end = buffer_temp
+        self.buffer_temp_peak = buffer_temp if buffer_temp is not None else float("-inf")
+
+    def _end_burn(self, timestamp):
+        self.burning = False
+        duration = timestamp - self.start_time
+        if duration < self.min_duration:
+            return None
+
+        self.num_burns += 1
+        covered = self.covered or 1.0
+        summary = {
+            "start": self.start_time,
+            "end": timestamp,
+            "duration_min": round(duration / 60.0, 1),
+            "peak_exhaust_temp": self.peak_exhaust_temp,
+            "mean_rest_o2": round(self.o2_integral / covered, 2),
+            "mean_primary_air": round(self.primary_air_integral / covered, 1),
+            "mean_secondary_air": round(self.secondary_air_integral / covered, 1),
+            "good_combustion_min": round(self.good_combustion / 60.0, 1),
+            "good_combustion_fraction": round(self.good_combustion / covered, 3),
+            "buffer_energy_kWh": None,
+            "buffer_energy_peak_kWh": None
+        }
+
+        # energy put into the buffer tank, from the mean of its three temperatures; the peak value also
+        # counts heat that was already drawn off during the burn
+        if self.buffer_temp_start is not None:
+            summary["buffer_energy_kWh"] = round((self.buffer_temp_end - self.buffer_temp_start) * self.buffer_kWh_per_K, 2)
+            summary["buffer_energy_peak_kWh"] = round((self.buffer_temp_peak - self.buffer_temp_start) * self.buffer_kWh_per_K, 2)
+        return summary
+
+def analyse_recording(path, **kwargs):
+    # runs the analyser over the M1 frames of a recording made with froelingsim.py; returns the burn summaries
+    # (start and end in seconds since the start of the recording) and the number of M1 frames
+    from froeling import OfflineLambdatronicS3100
+    from froelingsim import recorded_frames
+
+    froeling = OfflineLambdatronicS3100()
+    analyser = BurnCycleAnalyser(**kwargs)
+    summaries = []
+    num_frames = 0
+
+    for timestamp, frame in recorded_frames(path):
+        try:
+            cmd = froeling.parse_frame(frame)
+        except ConnectionError as e:
+            print(f"Skipping frame at {timestamp:.1f} s: {e}")
+            continue
+
+        if cmd == b"M1" and froeling.has_metadata():
+            num_frames += 1
+            summary = analyser.update(froeling.parameter_values, timestamp)
+            if summary is not None:
+                summaries.append(summary)
+
+    return summaries, num_frames
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Burn-cycle statistics from a recorded Froeling session")
+    parser.add_argument("recording")
+    parser.add_argument("--start-exhaust-temp", type = float, default = 80.0)
+    parser.add_argument("--end-exhaust-temp", type = float, default = 60.0)
+    parser.add_argument("--min-duration", type = float, default = 600.0, help = "shortest burn reported, in seconds")
+    parser.add_argument("--o2-band", type = float, nargs = 2, default = [4.0, 8.0], help = "residual O2 range of good combustion, in %%")
+    parser.add_argument("--buffer-volume", type = float, default = 2000.0, help = "buffer tank volume in litres")
+    args = parser.parse_args()
+
+    start_time = time.monotonic()
+    summaries, num_frames = analyse_recording(args.recording, start_exhaust_temp = args.start_exhaust_temp,
+                                              end_exhaust_temp = args.end_exhaust_temp, min_duration = args.min_duration,
+                                              o2_band = args.o2_band, buffer_volume_l = args.buffer_volume)
+    elapsed = time.monotonic() - start_time
+
+    for summary in summaries:
+        print(summary)
+    print(f"{len(summaries)} burns in {num_frames} M1 frames, analysed in {elapsed:.2f} s")
@@ -0,0 +1,47 @@
+import math, time
+
+class AdaptiveCadence:
+
+    def __init__(self, min_interval, max_interval, low_rate, high_rate, half_life = 60.0):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("Need 0 < min_interval <= max_interval")
+        if not 0 < low_rate < high_rate:
+            raise ValueError("Need 0 < low_rate < high_rate")
+
+        # rates (signal units per second) at or below low_rate poll at max_interval,
+        # at or above high_rate at min_interval, log-linear in between
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.low_rate = low_rate
+        self.high_rate = high_rate
+        self.half_life = half_life
+
+        self.interval = min_interval
+        self.rate = high_rate
+        self.last_values = None
+        self.last_time = None
+
+    def update(self, values, timestamp = None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+
+        if self.last_values is not None and timestamp > self.last_time:
+            dt = timestamp - self.last_time
+            rate = max(abs(values[key] - self.last_values[key]) / dt for key in values)
+
+            # peak hold with exponential release: transients shorten the interval at once,
+            # calm periods lengthen it gradually
+            self.rate = max(rate, self.rate * 0.5 ** (dt / self.half_life))
+
+        self.last_values = dict(values)
+        self.last_time = timestamp
+        self.interval = self._interval_for_rate(self.rate)
+        return self.interval
+
+    def _interval_for_rate(self, rate):
+        if rate <= self.low_rate:
+            return self.max_interval
+        if rate >= self.high_rate:
+            return self.min_interval
+
+        fraction = math.log(rate / self.low_rate) / math.log(self.high_rate / self.low_rate)
+        return self.max_interval - fraction * (self.max_interval - self.min_interval)
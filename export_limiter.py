@@ -0,0 +1,71 @@
+import time
+
+class ExportLimiter:
+
+    def __init__(self, export_limit_kW, rated_power_kW, margin_kW = 0.1, deadband_kW = 0.05,
+                 max_ramp_kW_per_s = 0.2, min_write_interval = 2.0, min_percent = 2.0, battery_feed_forward = 0.5):
+        if rated_power_kW <= 0:
+            raise ValueError("Need rated_power_kW > 0")
+
+        # positive grid power is export; the loop aims margin_kW below the cap and leaves
+        # deviations smaller than deadband_kW alone
+        self.export_limit_kW = export_limit_kW
+        self.rated_power_kW = rated_power_kW
+        self.margin_kW = margin_kW
+        self.deadband_kW = deadband_kW
+
+        # lowering the limit takes effect at once, raising it is slew-limited
+        self.max_ramp_kW_per_s = max_ramp_kW_per_s
+        self.min_write_interval = min_write_interval
+        self.min_percent = min_percent
+        self.battery_feed_forward = battery_feed_forward
+
+        self.limit_percent = None
+        self.last_write_time = None
+        self.last_battery_power_kW = None
+        self.setpoint_error_kW = 0.0
+
+    def update(self, grid_power_kW, hoymiles_power_kW, battery_power_charge_kW, timestamp = None):
+        # returns the power limit (percent of rated power) to write, or None if the current one stands
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        self.setpoint_error_kW = grid_power_kW - self.export_limit_kW
+
+        error_kW = self.export_limit_kW - self.margin_kW - grid_power_kW
+
+        # feed-forward: charge power the battery stopped absorbing since the last sample tends to keep
+        # falling (tapering towards full, mode changes), and would show up as export on the next one
+        if self.last_battery_power_kW is not None:
+            error_kW -= self.battery_feed_forward * max(0.0, self.last_battery_power_kW - battery_power_charge_kW)
+        self.last_battery_power_kW = battery_power_charge_kW
+
+        if self.limit_percent is None:
+            target_kW = hoymiles_power_kW + error_kW
+        else:
+            if abs(error_kW) < self.deadband_kW:
+                return None
+
+            # anti-windup: a limit above the actual output is not binding, so correct from the output
+            limit_kW = self.limit_percent / 100.0 * self.rated_power_kW
+            target_kW = min(limit_kW, hoymiles_power_kW) + error_kW
+            if target_kW > limit_kW:
+                # the step is bounded by one write interval, also after long stretches without writes
+                elapsed = min(timestamp - self.last_write_time, self.min_write_interval)
+                target_kW = min(target_kW, limit_kW + self.max_ramp_kW_per_s * elapsed)
+
+        percent = round(min(100.0, max(self.min_percent, 100.0 * target_kW / self.rated_power_kW)), 1)
+
+        if self.limit_percent is not None:
+            if abs(percent - self.limit_percent) < 0.5:
+                return None
+
+            # only a cap violation may bypass the minimum write interval
+            urgent = percent < self.limit_percent and self.setpoint_error_kW > 0.0
+            if timestamp - self.last_write_time < self.min_write_interval and not urgent:
+                return None
+
+        return percent
+
+    def commit(self, percent, timestamp = None):
+        # called once the limit has been written to all DTUs
+        self.limit_percent = percent
+        self.last_write_time = time.monotonic() if timestamp is None else timestamp
@@ -1,15 +1,92 @@
-import socket, ctypes, time, datetime, timeutils
+import asyncio, socket, codecs, ctypes, time, datetime, hashlib, json, operator, os, struct, sys, timeutils
+from tracing import get_tracer, TX, RX, RX_INVALID
 from socket import AF_UNSPEC, SOCK_STREAM
 
+# frames are <2 byte command> <1 byte payload length> <payload> <2 byte checksum>
+FRAME_HEADER_LEN = 3
+MAX_FRAME_LEN = FRAME_HEADER_LEN + 0xFF + 2
+RX_BUFFER_SIZE = 4096
+
+# first command byte of frames from the boiler (M: data, R: answers to requests)
+FRAME_PREFIXES = (0x4D, 0x52)
+
+# M3 frames: <2 byte error number> <1 byte state> <7 byte time, as in M2 frames> <text>
+ERROR_STATES = {0x01: "active", 0x02: "acknowledged", 0x04: "gone"}
+
+def _compile_slots(selected, code):
+    # one struct for an M1 frame that unpacks the selected 2 byte slots and skips the others as pad bytes
+    fmt = ">"
+    pad = 0
+    for is_selected in selected:
+        if not is_selected:
+            pad += 2
+            continue
+        if pad > 0:
+            fmt += f"{pad}x"
+            pad = 0
+        fmt += code
+    if pad > 0:
+        fmt += f"{pad}x"
+    return struct.Struct(fmt)
+
+class MeasurementDecoder:
+
+    # compiled once per set of metadata: an M1 frame decodes in one struct unpack for the values and one
+    # for the string-type parameters, with unsubscribed parameters skipped as pad bytes; string-type
+    # parameters carry an index into the display texts and resolve to the text stored there
+    def __init__(self, parameter_names, parameter_formats, subscribed = None, display_texts = None):
+        names = []
+        divisors = []
+        text_names = []
+        is_value = []
+        is_text = []
+
+        for parameter_name in parameter_names:
+            parameter_format = parameter_formats.get(parameter_name["index"])
+            wanted = parameter_format is not None and (subscribed is None or parameter_name["name"] in subscribed)
+
+            is_value.append(wanted and parameter_name["type"] == "value")
+            is_text.append(wanted and parameter_name["type"] == "string" and display_texts is not None)
+            if is_value[-1]:
+                names.append(parameter_name["name"])
+                divisors.append(parameter_format["divisor"] or 1)
+            elif is_text[-1]:
+                text_names.append(parameter_name["name"])
+
+        self.unpacker = _compile_slots(is_value, "h")
+        self.names = tuple(names)
+        self.divisors = tuple(divisors)
+
+        self.text_unpacker = _compile_slots(is_text, "H")
+        self.text_names = tuple(text_names)
+        self.display_texts = display_texts
+
+    def decode(self, payload, values):
+        values.update(zip(self.names, map(operator.truediv, self.unpacker.unpack(payload), self.divisors)))
+        if self.text_names:
+            values.update(zip(self.text_names, map(self.display_texts.get, self.text_unpacker.unpack(payload))))
+
 class LambdatronicS3100:
 
-    def __init__(self, host, port, timeout = 0.1, debug = True):
+    def __init__(self, host, port, timeout = 0.1, debug = True, cache_path = None):
         self.debug = debug
         self.host = host
         self.port = port
         self.timeout = timeout
+
+        # every frame goes into an always-on ring buffer, formatted only when dumped
+        self.tracer = get_tracer(f"froeling_{host}_{port}")
         self.sock = self._init_socket(host, port, timeout)
 
+        # frames are parsed in place from the receive buffer; the ACKs for all frames
+        # taken from one read are sent together
+        self.rx_buffer = bytearray(RX_BUFFER_SIZE)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.rx_start = 0
+        self.rx_end = 0
+        self.tx_pending = bytearray()
+        self.last_rx_time = 0.0
+
         self.init_complete = False
         self.date_time = {"last_updated": "Never"}
         
@@ -17,8 +94,125 @@ class LambdatronicS3100:
         self.parameter_formats = {}
         self.parameter_values = {"last_updated": "Never"}
 
+        # MB display texts by index, each stored once; they are updated in place as the boiler streams them
+        self.display_texts = {}
+        self.display_texts_changed = False
+
+        # errors reported in M3 frames by error number, until the boiler reports them gone;
+        # errors_version counts the changes, so that consumers publish only when it moved
+        self.active_errors = {}
+        self.errors_version = 0
+
+        # rebuilt whenever the metadata or the subscription changes
+        self.subscribed = None
+        self.decoder = None
+
+        # MA / MC frames streamed by the boiler after login; they replace the metadata
+        # in use once the M2 time frame marks the end of the metadata stream
+        self.received_parameter_names = []
+        self.received_parameter_formats = {}
+
+        # with a cached copy of the metadata, M1 frames are decoded before the boiler has streamed it
+        self.cache_path = cache_path
+        self.metadata_source = "none"
+        if cache_path is not None:
+            self._load_metadata_cache()
+
+    def _cache_key(self):
+        return f"{self.host}:{self.port}"
+
+    def _metadata_fingerprint(self, parameter_names, parameter_formats):
+        # the boiler does not report a firmware version; its parameter layout identifies it instead
+        metadata = json.dumps([parameter_names, sorted(parameter_formats.items())], sort_keys = True)
+        return hashlib.sha1(metadata.encode("utf-8")).hexdigest()
+
+    def _read_cache_file(self):
+        if not os.path.isfile(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            print(f"Froeling metadata cache {self.cache_path} unreadable, ignoring it.")
+            return {}
+
+    def _load_metadata_cache(self):
+        entry = self._read_cache_file().get(self._cache_key())
+        if entry is None:
+            return
+
+        parameter_names = entry["parameter_names"]
+        parameter_formats = {int(index): parameter_format for index, parameter_format in entry["parameter_formats"].items()}
+
+        if self._metadata_fingerprint(parameter_names, parameter_formats) != entry["fingerprint"]:
+            print("Froeling metadata cache corrupt, ignoring it.")
+            return
+
+        self.display_texts.update((int(index), sys.intern(text)) for index, text in entry.get("display_texts", {}).items())
+        self._set_metadata(parameter_names, parameter_formats)
+        self.metadata_source = "cache"
+
+    def _save_metadata_cache(self):
+        cache = self._read_cache_file()
+        cache[self._cache_key()] = {
+            "fingerprint": self._metadata_fingerprint(self.parameter_names, self.parameter_formats),
+            "saved": timeutils.get_current_timestamp(),
+            "parameter_names": self.parameter_names,
+            "parameter_formats": self.parameter_formats,
+            "display_texts": self.display_texts
+        }
+
+        # write to a temporary file first, so that an interrupted write never leaves a truncated cache
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Froeling metadata cache could not be written: {e}")
+
+    def _invalidate_cached_metadata(self, reason):
+        print(f"Froeling metadata cache out of date ({reason}), waiting for the boiler's metadata.")
+        self._set_metadata([], {})
+        self.metadata_source = "none"
+
+    def _complete_metadata(self):
+        received_parameter_names, self.received_parameter_names = self.received_parameter_names, []
+        received_parameter_formats, self.received_parameter_formats = self.received_parameter_formats, {}
+
+        if len(received_parameter_names) == 0:
+            # nothing streamed since the last M2 frame, keep what is in use
+            return
+
+        unchanged = received_parameter_names == self.parameter_names and received_parameter_formats == self.parameter_formats
+        self._set_metadata(received_parameter_names, received_parameter_formats)
+        self.metadata_source = "boiler"
+
+        if self.cache_path is not None and (not unchanged or self.display_texts_changed):
+            self._save_metadata_cache()
+        self.display_texts_changed = False
+
+    def _set_metadata(self, parameter_names, parameter_formats):
+        self.parameter_names = parameter_names
+        self.parameter_formats = parameter_formats
+        self.decoder = MeasurementDecoder(parameter_names, parameter_formats, self.subscribed, self.display_texts) if parameter_names else None
+
+    def subscribe(self, names):
+        # decode only the given parameters from now on (None decodes all of them)
+        self.subscribed = None if names is None else frozenset(names)
+        self._set_metadata(self.parameter_names, self.parameter_formats)
+
+    def has_metadata(self):
+        return len(self.parameter_names) > 0
+
     def _init_socket(self, host, port, timeout):
-        for res in socket.getaddrinfo(host, port, AF_UNSPEC, SOCK_STREAM):
+        try:
+            addresses = socket.getaddrinfo(host, port, AF_UNSPEC, SOCK_STREAM)
+        except socket.error as e:
+            raise ConnectionError(f"Error: cannot resolve {host}") from e
+
+        for res in addresses:
             af, sock_type, proto, canon_name, sa = res
             
             try:
@@ -32,9 +226,13 @@ class LambdatronicS3100:
             except socket.error:
                 sock.close()
                 continue            
-            break
+            return sock
+
+        raise ConnectionError(f"Error: cannot connect to {host}:{port}")
 
-        return sock
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
         
     def _calculate_checksum(self, frame):
         checksum = sum(frame)
@@ -42,9 +240,7 @@ class LambdatronicS3100:
         return checksum.to_bytes(2, byteorder = "big", signed = False)
 
     def _verify_checksum(self, frame):
-        exp = self._calculate_checksum(frame[:-2])
-        obs = frame[-2:]
-        return exp == obs
+        return sum(frame[:-2]) & 0xFFFF == (frame[-2] << 8) | frame[-1]
 
     def _buffer_to_string(self, inbuf):
         return " ".join(map(hex, inbuf))
@@ -56,7 +252,7 @@ class LambdatronicS3100:
         return int.from_bytes(inbuf, byteorder = "big", signed = True)
     
     def _decode_cp850(self, inbuf):
-        return inbuf.decode('cp850')
+        return codecs.decode(inbuf, 'cp850')
     
     def _send_frame(self, tx_frame):
         if not isinstance(tx_frame, bytes):
@@ -68,42 +264,70 @@ class LambdatronicS3100:
         if self.debug:
             print("TX: " + self._buffer_to_string(full_frame))
         
-        return self.sock.send(full_frame)
+        return self._write(full_frame)
 
-    def _recv_bytes(self, num_bytes):
-        inbuf = self.sock.recv(num_bytes)
+    def _write(self, data):
+        self.tracer.record(TX, data)
+        try:
+            self.sock.sendall(data)
+        except OSError as e:
+            raise ConnectionError("Error: communication failure") from e
+        return len(data)
+
+    def _rx_free_space(self):
+        if self.rx_start == self.rx_end:
+            self.rx_start = self.rx_end = 0
+        elif RX_BUFFER_SIZE - self.rx_end < MAX_FRAME_LEN:
+            # move the trailing partial frame to the front
+            partial_frame = bytes(self.rx_view[self.rx_start : self.rx_end])
+            self.rx_end = len(partial_frame)
+            self.rx_start = 0
+            self.rx_view[:self.rx_end] = partial_frame
+
+        return self.rx_view[self.rx_end:]
+
+    def _fill_rx_buffer(self):
+        # reads whatever the socket has available, returns False on timeout
+        try:
+            num_bytes = self.sock.recv_into(self._rx_free_space())
+        except TimeoutError:
+            return False
+        except OSError as e:
+            raise ConnectionError("Error: communication failure") from e
 
-        while True:
-            diff = num_bytes - len(inbuf)
+        if num_bytes == 0:
+            raise ConnectionError("Error: connection closed by peer")
 
-            if diff == 0:
-                return inbuf
-            
-            inbuf += self.sock.recv(diff)
-    
-    def _receive_frame(self):
-        
-        try:
-            header_bytes = 3
-            header = self._recv_bytes(header_bytes)
+        self.rx_end += num_bytes
+        return True
 
-            if len(header) != header_bytes:
-                raise ConnectionError("Error: communication failure")
-            
-            frame_len = header[2]
-            payload = self._recv_bytes(frame_len + 2) # including 2 checksum bytes
+    def _next_frame(self):
+        # returns the next complete, valid frame as a view into the receive buffer, or None
+        while self.rx_end - self.rx_start >= FRAME_HEADER_LEN:
+            if self.rx_buffer[self.rx_start] not in FRAME_PREFIXES:
+                self.rx_start += 1
+                continue
 
-            full_frame = header + payload
-            
+            frame_len = FRAME_HEADER_LEN + self.rx_buffer[self.rx_start + 2] + 2
+            if self.rx_end - self.rx_start < frame_len:
+                return None
+
+            frame = self.rx_view[self.rx_start : self.rx_start + frame_len]
+            if self._verify_checksum(frame):
+                self.rx_start += frame_len
+                self.last_rx_time = time.monotonic()
+                self.tracer.record(RX, frame)
+                if self.debug:
+                    print("RX: " + self._buffer_to_string(frame))
+                return frame
+
+            # resynchronise byte by byte after a corrupted frame
+            self.tracer.record(RX_INVALID, frame)
             if self.debug:
-                print("RX: " + self._buffer_to_string(full_frame))
-                print("Header: {}, Payload: {}".format(self._buffer_to_string(header),
-                                                       self._buffer_to_string(payload)))
+                print("RX: checksum error, skipping one byte")
+            self.rx_start += 1
 
-            return full_frame
-                  
-        except TimeoutError:
-            return None
+        return None
 
     def _split_frame(self, frame):
         command = frame[:2]
@@ -114,19 +338,21 @@ class LambdatronicS3100:
         assert len(command) + 1 + len(payload) + len(checksum) == len(frame)
         return command, payload
         
-    def _receive_validate_frame(self):
-        frame = self._receive_frame()
-        if frame is None:
-            return None
-
-        if self._verify_checksum(frame):
-            return frame
-        else:
-            return None
-        
     def _send_ack(self, cmd):
-        frame = cmd + bytes([0x01, 0x01])
-        return self._send_frame(frame)
+        ack = bytes(cmd) + bytes([0x01, 0x01])
+        self.tx_pending += ack + self._calculate_checksum(ack)
+
+    def _flush_acks(self):
+        if len(self.tx_pending) == 0:
+            return
+
+        if self.debug:
+            print("TX: " + self._buffer_to_string(self.tx_pending))
+
+        try:
+            self._write(bytes(self.tx_pending))
+        finally:
+            self.tx_pending.clear()
 
     def _is_ack(self, payload):
         return len(payload) == 1 and payload[0] == 0x01
@@ -134,11 +360,7 @@ class LambdatronicS3100:
     def _parse_bcd(self, byte):
         return (byte >> 4) * 10 + (byte & 0x0F)
     
-    def _parse_date_time(self, payload):
-
-        if not len(payload) == 7:
-            return
-
+    def _decode_date_time(self, payload):
         seconds = self._parse_bcd(payload[0])
         minutes = self._parse_bcd(payload[1])
         hours = self._parse_bcd(payload[2])
@@ -147,9 +369,61 @@ class LambdatronicS3100:
         weekday = payload[5] 
         year = 2000 + self._parse_bcd(payload[6])
 
-        self.date_time["date_time"] = timeutils.get_timestamp(datetime.datetime(year, month, day, hours, minutes, seconds))
+        return timeutils.get_timestamp(datetime.datetime(year, month, day, hours, minutes, seconds))
+
+    def _parse_date_time(self, payload):
+
+        if not len(payload) == 7:
+            return
+
+        self.date_time["date_time"] = self._decode_date_time(payload)
         self.date_time["last_updated"] = timeutils.get_current_timestamp()
 
+    def _parse_display_text(self, payload):
+
+        if len(payload) < 2:
+            raise ConnectionError("Wrong payload length")
+
+        index = self._bytes_to_U16(payload[0:2])
+        text = sys.intern(self._decode_cp850(payload[2:]).strip())
+
+        if self.display_texts.get(index) != text:
+            self.display_texts[index] = text
+            self.display_texts_changed = True
+
+    def _parse_error(self, payload):
+
+        if len(payload) < 10:
+            raise ConnectionError("Wrong payload length")
+
+        number = self._bytes_to_U16(payload[0:2])
+        state = ERROR_STATES.get(payload[2], "unknown")
+
+        if state == "gone":
+            if self.active_errors.pop(number, None) is not None:
+                self.errors_version += 1
+            return
+
+        previous = self.active_errors.get(number)
+        if previous is not None and previous["state"] == state:
+            # the boiler repeats its error list after every login
+            return
+
+        if previous is not None:
+            since = previous["since"]
+        else:
+            try:
+                since = self._decode_date_time(payload[3:10])
+            except ValueError:
+                since = timeutils.get_current_timestamp()
+
+        self.active_errors[number] = {
+            "text": sys.intern(self._decode_cp850(payload[10:]).strip()),
+            "state": state,
+            "since": since
+        }
+        self.errors_version += 1
+
     def _parse_parameter_names(self, payload):
 
         parameter_name = {}
@@ -164,8 +438,14 @@ class LambdatronicS3100:
         parameter_name["index"] = self._bytes_to_U16(payload[1:3])
         parameter_name["unknown"] = self._bytes_to_U16(payload[3:5])
         parameter_name["name"] = self._decode_cp850(payload[5:]).strip()
-        
-        self.parameter_names.append(parameter_name)
+
+        # validate the cached metadata entry by entry as the boiler streams its own
+        position = len(self.received_parameter_names)
+        if self.metadata_source == "cache" and \
+           (position >= len(self.parameter_names) or self.parameter_names[position] != parameter_name):
+            self._invalidate_cached_metadata(f"parameter {position} differs")
+
+        self.received_parameter_names.append(parameter_name)
 
     def _parse_parameter_format(self, payload):
 
@@ -180,32 +460,24 @@ class LambdatronicS3100:
             "unknown": self._bytes_to_U16(payload[6:])
         }
 
-        self.parameter_formats[index] = parameter_format
+        if self.metadata_source == "cache" and self.parameter_formats.get(index) != parameter_format:
+            self._invalidate_cached_metadata(f"format of parameter {index} differs")
+
+        self.received_parameter_formats[index] = parameter_format
 
-    def _parse_parameter(self, ind, param_buf):        
-        cur_param_name = self.parameter_names[ind]
-        cur_param_ind = cur_param_name["index"]
-        cur_param_format = self.parameter_formats[cur_param_ind]
-        
-        if cur_param_name["type"] == "value":            
-            cur_param_val = self._bytes_to_L16(param_buf) / cur_param_format["divisor"]
-            self.parameter_values[cur_param_name["name"]] = cur_param_val
-        else:
-            if self.debug:
-                print("Reading display texts not currently supported")
-        
     def _parse_measurements(self, payload):
-        
-        def chunk(inlist, chunk_length):
-            for cur_chunk in range(0, len(inlist), chunk_length):
-                yield inlist[cur_chunk:cur_chunk + chunk_length]
+
+        if not self.has_metadata():
+            # cached metadata was dropped, the frames are decoded again once the boiler's metadata is complete
+            return
 
         if not len(payload) == 2 * len(self.parameter_names):
+            if self.metadata_source == "cache":
+                self._invalidate_cached_metadata("M1 frame length differs")
+                return
             raise ConnectionError("Wrong payload length")
-                
-        for ind, cur_param_buf in enumerate(chunk(payload, 2)):
-            self._parse_parameter(ind, cur_param_buf)
 
+        self.decoder.decode(payload, self.parameter_values)
         self.parameter_values["last_updated"] = timeutils.get_current_timestamp()
         
     def _parse_cmd(self, cmd, payload):
@@ -220,16 +492,17 @@ class LambdatronicS3100:
         elif cmd_selector == 0x32:
             # M2 command: time
             self.init_complete = True # once time is sent, everything is fully initialized
+            self._complete_metadata()
             self._parse_date_time(payload)
         elif cmd_selector == 0x33:
             # M3 command: error messages
-            pass
+            self._parse_error(payload)
         elif cmd_selector == 0x41:
             # MA command: description of measurements
             self._parse_parameter_names(payload)
         elif cmd_selector == 0x42:
             # MB command: display texts
-            pass
+            self._parse_display_text(payload)
         elif cmd_selector == 0x43:
             # MC command: formatting of measurements
             self._parse_parameter_format(payload)
@@ -253,21 +526,186 @@ class LambdatronicS3100:
         frame = [0x52, 0x62, 0x03, 0x00, 0x00, 0x00]
         return self._send_frame(frame)
     
+    def _parse_buffered_frames(self):
+        num_parsed = 0
+
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return num_parsed
+
+            cmd, payload = self._split_frame(frame)
+            if self._is_ack(payload):
+                continue
+
+            self._send_ack(cmd)
+            self._parse_cmd(cmd, payload)
+            num_parsed += 1
+
     def receive_and_parse(self):
+        # parses every complete frame that is buffered, reading from the socket only if there is none;
+        # returns False once a read times out without a new frame
+        try:
+            num_parsed = self._parse_buffered_frames()
+            if num_parsed == 0 and self._fill_rx_buffer():
+                num_parsed = self._parse_buffered_frames()
+        finally:
+            self._flush_acks()
 
-        frame = self._receive_validate_frame()
-        if frame is None:
-            return False
+        return num_parsed > 0
+        
+class OfflineLambdatronicS3100(LambdatronicS3100):
+
+    # decodes frames handed to it, e.g. from a recording made with froelingsim.py; nothing is sent
+    def __init__(self, subscribed = None):
+        super().__init__("offline", 0, debug = False)
+        self.subscribe(subscribed)
+
+    def _init_socket(self, host, port, timeout):
+        return None
+
+    def _write(self, data):
+        pass
+
+    def parse_frame(self, frame):
+        # returns the command of a valid frame, None for a corrupted one
+        if len(frame) < FRAME_HEADER_LEN + 2 or not self._verify_checksum(frame):
+            self.tracer.record(RX_INVALID, frame)
+            return None
 
         cmd, payload = self._split_frame(frame)
+        if not self._is_ack(payload):
+            self._parse_cmd(cmd, payload)
+        return bytes(cmd)
 
-        if self._is_ack(payload):
-            return False
+class AsyncLambdatronicS3100(LambdatronicS3100, asyncio.BufferedProtocol):
+
+    # asyncio variant: the event loop receives straight into the frame buffer, frames are parsed and
+    # ACKed as they arrive and measurement updates are pushed to subscribers; run() keeps the connection up
+    def __init__(self, host, port, timeout = 5.0, debug = False, cache_path = None,
+                 login_mode = "service", idle_timeout = 30.0, reconnect_delay = 10.0):
+        super().__init__(host, port, timeout = timeout, debug = debug, cache_path = cache_path)
+
+        self.login_mode = login_mode
+        self.idle_timeout = idle_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.transport = None
+        self.closed = None
+        self.last_rx_time = 0.0
+        self.status_requested = False
+
+        # subscribers are coroutine functions called with parameter_values; bursts of M1 frames
+        # are coalesced into one call
+        self.subscribers = []
+        self.measurements_updated = None
+
+    def _init_socket(self, host, port, timeout):
+        # connections are made by run() on the event loop
+        return None
+
+    def add_subscriber(self, callback):
+        self.subscribers.append(callback)
+
+    def _write(self, data):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("Error: not connected")
+        self.tracer.record(TX, data)
+        self.transport.write(data)
+        return len(data)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.last_rx_time = time.monotonic()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    def get_buffer(self, sizehint):
+        return self._rx_free_space()
+
+    def buffer_updated(self, num_bytes):
+        self.rx_end += num_bytes
+        self.last_rx_time = time.monotonic()
+
+        try:
+            self._parse_buffered_frames()
+            self._flush_acks()
+        except ConnectionError as e:
+            print(f"Froeling protocol error: {e}")
+            print(self.tracer.format(last = 50))
+            self.transport.close()
+
+    def eof_received(self):
+        return False
+
+    def _parse_measurements(self, payload):
+        super()._parse_measurements(payload)
+        self.measurements_updated.set()
+
+    def _parse_cmd(self, cmd, payload):
+        super()._parse_cmd(cmd, payload)
+
+        # without cached metadata, measurements are requested once the metadata is complete
+        if self.init_complete and not self.status_requested:
+            self.status_requested = True
+            self.request_status()
+
+    async def _dispatch(self):
+        while True:
+            await self.measurements_updated.wait()
+            self.measurements_updated.clear()
+            for callback in self.subscribers:
+                try:
+                    await callback(self.parameter_values)
+                except Exception as e:
+                    print(f"Froeling subscriber failed: {e}")
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        self.rx_start = self.rx_end = 0
+        self.tx_pending.clear()
+        self.init_complete = False
+        self.status_requested = False
+
+        await asyncio.wait_for(loop.create_connection(lambda: self, self.host, self.port), self.timeout)
+        self.send_login(mode = self.login_mode)
+
+        if self.has_metadata():
+            self.status_requested = True
+            self.request_status()
+
+    async def run(self):
+        self.measurements_updated = asyncio.Event()
+        dispatcher = asyncio.ensure_future(self._dispatch())
+
+        try:
+            while True:
+                try:
+                    await self._connect()
+
+                    # a boiler that goes silent without closing the connection is treated as disconnected
+                    while not self.closed.done():
+                        await asyncio.wait([self.closed], timeout = self.idle_timeout)
+                        if not self.closed.done() and time.monotonic() - self.last_rx_time > self.idle_timeout:
+                            print("Froeling connection idle, reconnecting.")
+                            self.transport.close()
+                            await self.closed
+
+                    print("Froeling connection closed, reconnecting.")
+
+                except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                    print(f"Froeling connection failed: {e!r}")
+
+                await asyncio.sleep(self.reconnect_delay)
+        finally:
+            dispatcher.cancel()
+            if self.transport is not None:
+                self.transport.close()
 
-        self._send_ack(cmd)
-        self._parse_cmd(cmd, payload)
-        return True
-        
 if __name__ == "__main__":
 
     froeling = LambdatronicS3100(host = '192.168.1.147', port = 23, debug = False)
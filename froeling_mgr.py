@@ -1,5 +1,44 @@
 import appdaemon.plugins.hass.hassapi as hass
-from froeling import LambdatronicS3100
+from froeling import LambdatronicS3100, AsyncLambdatronicS3100
+from burncycle import BurnCycleAnalyser
+import datetime, os, time, timeutils, tracing
+
+# boiler parameters published by this app; all other parameters in the M1 frames are skipped when decoding
+PUBLISHED_PARAMETERS = [
+    "Kesseltemp",
+    "Abgastemp.",
+    "Abgas. SW",
+    "Kesselzust.",
+    "Saugzug",
+    "Prim.Luft",
+    "Sek.Luft",
+    "Rest-O2",
+    "Puffert.ob",
+    "Puffert.mi",
+    "Puffert.un",
+    "Außentemp",
+    "Vorlauft.1sw",
+    "Vorlauft.1",
+    "Vorlauft.2sw",
+    "Vorlauft.2",
+    "Boardtemp."
+]
+
+# initialisation phases and their status texts; connect -> login -> metadata -> streaming
+PHASE_STATUS = {
+    "connect": "Connecting",
+    "login": "Logging in",
+    "metadata": "Receiving metadata",
+    "streaming": "Active"
+}
+
+# seconds until a phase is retried from scratch; metadata and streaming time out once no frame
+# arrived for that long, login once the phase itself lasts longer
+DEFAULT_PHASE_TIMEOUTS = {
+    "login": 10,
+    "metadata": 30,
+    "streaming": 30
+}
 
 class FroelingMgr(hass.Hass):
 
@@ -8,52 +47,171 @@ class FroelingMgr(hass.Hass):
                              friendly_name = "Status Froeling",
                              msg_text = "Starting")
 
-        self.run_in(self.initialize_froeling, 20)
+        # the boiler, or froelingsim.py serving a simulated or recorded one
+        self.host = self.args.get("host", "192.168.1.147")
+        self.port = self.args.get("port", 23)
+
+        # parameter names and formats from the last session, keyed by boiler address
+        self.metadata_cache = self.args.get("metadata_cache", os.path.join(os.path.dirname(os.path.abspath(__file__)), "froeling_metadata.json"))
+
+        startup_delay = 0 if os.path.isfile(self.metadata_cache) else self.args.get("startup_delay", 20)
+        self.froeling_task = None
+        self.froeling = None
+        self.tracer = None
+        self.published_errors_version = None
+
+        # per-burn statistics from the measurement stream, published at the end of every burn
+        self.burn_analyser = BurnCycleAnalyser(start_exhaust_temp = self.args.get("burn_start_exhaust_temp", 80.0),
+                                               end_exhaust_temp = self.args.get("burn_end_exhaust_temp", 60.0),
+                                               min_duration = self.args.get("burn_min_duration", 600),
+                                               o2_band = self.args.get("burn_o2_band", [4.0, 8.0]),
+                                               buffer_volume_l = self.args.get("buffer_volume_l", 2000))
+
+        # fire "dump_trace" (optionally with name, path and last) to dump the protocol trace
+        self.listen_event(self.dump_trace, "dump_trace")
+
+        if self.args.get("froeling_async", False):
+            # frames are handled on the event loop as they arrive and measurements are published on arrival
+            self.run_in(self.initialize_froeling_async, startup_delay)
+        else:
+            self.run_in(self.initialize_froeling, startup_delay)
+
+    def terminate(self):
+        if self.froeling_task is not None:
+            self.froeling_task.cancel()
 
     def initialize_froeling(self, kwargs):
-        self.publish_message(var_name = "froeling_status",
-                             friendly_name = "Status Froeling",
-                             msg_text = "Initializing")
 
-        # initialize everything
-        self.froeling = LambdatronicS3100(host = '192.168.1.147', port = 23, timeout = 0.1, debug = False)
-        self.froeling.send_login(mode = "service")
+        # the connection is brought up one step per frame burst by handle_protocol, which never waits
+        # longer than one socket timeout, so no worker thread is held during initialisation
+        self.phase_timeouts = dict(DEFAULT_PHASE_TIMEOUTS, **self.args.get("phase_timeouts", {}))
+        self.retry_delay = self.args.get("retry_delay", 10)
+        self.retries = 0
+        self.froeling = None
+        self.enter_phase("connect")
+
+        # schedule callbacks
+        self.run_every(self.handle_protocol, "now", 1)
+        self.run_every(self.publish_measurements, "now", 1)
+
+    async def initialize_froeling_async(self, kwargs):
+
+        self.froeling = AsyncLambdatronicS3100(host = self.host, port = self.port, debug = False,
+                                               cache_path = self.metadata_cache)
+        self.froeling.subscribe(PUBLISHED_PARAMETERS)
+        self.froeling.add_subscriber(self.on_measurements)
+        self.tracer = self.froeling.tracer
+        self.published_errors_version = None
 
-        while True:
-            self.froeling.receive_and_parse()
-            if self.froeling.init_complete:
-                break
+        # reconnects are handled by the client itself, no restart of the app needed
+        self.froeling_task = self.create_task(self.froeling.run())
 
-        self.froeling.request_status()
-            
+        await self.run_in_executor(self.publish_message, "froeling_status", "Status Froeling", "Active")
+
+    async def on_measurements(self, parameter_values):
+        await self.run_in_executor(self.publish_measurements, {})
+
+    def enter_phase(self, phase):
+        self.phase = phase
+        self.phase_start = time.monotonic()
+
+        status = PHASE_STATUS[phase] if self.retries == 0 else f"{PHASE_STATUS[phase]} (retry {self.retries})"
         self.publish_message(var_name = "froeling_status",
                              friendly_name = "Status Froeling",
-                             msg_text = "Active")
-            
-        # schedule callbacks
-        self.run_every(self.handle_protocol, "now", 1)
-        self.run_every(self.publish_measurements, "now+10", 1)
+                             msg_text = status)
 
     def handle_protocol(self, kwargs):
         try:
-            while self.froeling.receive_and_parse():
-                pass
-        except ConnectionError:
-            print("Froeling connection error, scheduling restart.")
-            self.schedule_restart()
+            if self.phase == "connect":
+                self.connect()
+            else:
+                while self.froeling.receive_and_parse():
+                    self.advance_phase()
+                self.advance_phase()
+                self.check_phase_timeout()
+        except ConnectionError as e:
+            self.retry(f"connection error: {e}")
 
-    def schedule_restart(self):
-        self.publish_message(var_name = "froeling_status",
-                             friendly_name = "Status Froeling",
-                             msg_text = "In restart")        
-        self.restart_app("froeling_mgr")
+    def connect(self):
+        if self.retries > 0 and time.monotonic() - self.phase_start < self.retry_delay:
+            return
+
+        self.froeling = LambdatronicS3100(host = self.host, port = self.port, timeout = 0.1, debug = False,
+                                          cache_path = self.metadata_cache)
+        self.froeling.subscribe(PUBLISHED_PARAMETERS)
+        self.tracer = self.froeling.tracer
+        self.published_errors_version = None
+        self.froeling.send_login(mode = "service")
+        self.enter_phase("login")
+
+    def advance_phase(self):
+        froeling = self.froeling
+
+        if self.phase == "login" and froeling.last_rx_time > self.phase_start:
+            if froeling.has_metadata():
+                # cached metadata: measurements right away, the boiler's metadata is checked as it arrives
+                froeling.request_status()
+                self.enter_phase("streaming")
+            else:
+                self.enter_phase("metadata")
+
+        # the metadata stream is only known to be complete once the M2 time frame follows it
+        if self.phase == "metadata" and froeling.init_complete:
+            froeling.request_status()
+            self.enter_phase("streaming")
+
+        if self.phase == "streaming" and self.retries > 0 and froeling.parameter_values["last_updated"] != "Never":
+            # measurements are flowing again
+            self.retries = 0
+            self.enter_phase("streaming")
+
+    def check_phase_timeout(self):
+        if self.phase in ("metadata", "streaming"):
+            since = max(self.phase_start, self.froeling.last_rx_time)
+        else:
+            since = self.phase_start
+
+        if time.monotonic() - since > self.phase_timeouts[self.phase]:
+            self.retry(f"timeout in phase '{self.phase}'")
+
+    def retry(self, reason):
+        print(f"Froeling {reason}, reconnecting in {self.retry_delay} s.")
+        if self.tracer is not None:
+            print(self.tracer.format(last = 50))
+
+        if self.froeling is not None:
+            self.froeling.close()
+            self.froeling = None
+
+        self.retries += 1
+        self.enter_phase("connect")
+
+    def dump_trace(self, event_name, data, kwargs):
+        if self.tracer is not None and data.get("name") in (None, self.tracer.name):
+            tracing.dump(names = [self.tracer.name], path = data.get("path"), last = data.get("last"))
 
     def publish_measurements(self, kwargs):
+
+        if self.froeling is None:
+            return
         
         self.publish_message(var_name = "froeling_lastdata",
                              friendly_name = "Letzte Aktualisierung der Heizungsdaten",
                              msg_text = self.froeling.parameter_values["last_updated"])
 
+        self.publish_message(var_name = "froeling_boiler_state",
+                             friendly_name = "Froeling Kesselzustand",
+                             msg_text = self.froeling.parameter_values.get("Kesselzust.") or "Unknown")
+
+        if self.froeling.parameter_values["last_updated"] != "Never":
+            burn_summary = self.burn_analyser.update(self.froeling.parameter_values)
+            if burn_summary is not None:
+                self.publish_burn_summary(burn_summary)
+
+        # the error list changes rarely, so it is only published when the boiler reported a change
+        if self.froeling.errors_version != self.published_errors_version:
+            self.publish_errors()
+
         self.publish_measurement(var_name = "froeling_boiler_temp",
                                  friendly_name = "Froeling Kesseltemperatur",
                                  value = self.froeling.parameter_values.get("Kesseltemp", 0.0),
@@ -134,6 +292,27 @@ class FroelingMgr(hass.Hass):
                                  value = self.froeling.parameter_values.get("Boardtemp.", 0.0),
                                  unit = "°C")
                 
+    def publish_burn_summary(self, summary):
+        attributes = dict(summary,
+                          start = timeutils.get_timestamp(datetime.datetime.fromtimestamp(summary["start"])),
+                          end = timeutils.get_timestamp(datetime.datetime.fromtimestamp(summary["end"])))
+        attributes.update({"friendly_name": "Froeling letzter Abbrand",
+                           "unit_of_measurement": "kWh",
+                           "device_class": "energy"})
+
+        self.set_state("sensor.froeling_last_burn",
+                       state = summary["buffer_energy_kWh"] if summary["buffer_energy_kWh"] is not None else "unknown",
+                       attributes = attributes)
+
+    def publish_errors(self):
+        self.published_errors_version = self.froeling.errors_version
+        errors = [dict(error, number = number) for number, error in sorted(self.froeling.active_errors.items())]
+
+        self.set_state("sensor.froeling_errors",
+                       state = len(errors),
+                       attributes = {"friendly_name": "Froeling Fehler",
+                                     "errors": errors})
+
     def publish_message(self, var_name, friendly_name, msg_text):
         self.set_state(f"sensor.{var_name}",
                        state = msg_text,
@@ -0,0 +1,376 @@
+import argparse, datetime, random, select, socket, socketserver, struct, threading, time
+from modbussim import Constant, Sine, RandomWalk
+
+# frames are <2 byte command> <1 byte payload length> <payload> <2 byte checksum>
+LOGIN = b"Ra"
+REQUEST_STATUS = b"Rb"
+ACK_PAYLOAD = b"\x01"
+
+TYPE_VALUE = 0x49
+TYPE_STRING = 0x53
+
+ERROR_ACTIVE = 0x01
+ERROR_ACKNOWLEDGED = 0x02
+ERROR_GONE = 0x04
+
+# recordings: magic, then one record per chunk of bytes as seen on the wire:
+# <uint32 milliseconds since start> <uint8 direction> <uint16 length> <data>
+RECORDING_MAGIC = b"FRLG\x01"
+RECORD_HEADER = struct.Struct(">IBH")
+FROM_BOILER = 0
+TO_BOILER = 1
+
+def make_frame(cmd, payload):
+    frame = bytes(cmd) + bytes([len(payload)]) + bytes(payload)
+    return frame + struct.pack(">H", sum(frame) & 0xFFFF)
+
+def split_frames(buffer):
+    # returns the complete frames at the start of buffer and the number of bytes they take up
+    frames = []
+    pos = 0
+    while len(buffer) - pos >= 3:
+        frame_len = 3 + buffer[pos + 2] + 2
+        if len(buffer) - pos < frame_len:
+            break
+        frames.append(bytes(buffer[pos : pos + frame_len]))
+        pos += frame_len
+    return frames, pos
+
+def _bcd(value):
+    return ((value // 10) << 4) | (value % 10)
+
+# (type, name, unit, divisor, waveform) of the parameters the default simulator serves
+DEFAULT_PARAMETERS = [
+    (TYPE_VALUE, "Kesseltemp", "°", 2, Sine(70.0, 8.0, 3600.0)),
+    (TYPE_VALUE, "Abgastemp.", "°", 1, Sine(120.0, 40.0, 3600.0, floor = 20.0)),
+    (TYPE_VALUE, "Abgas. SW", "°", 1, Constant(130.0)),
+    (TYPE_STRING, "Kesselzust.", " ", 1, Constant(3)),
+    (TYPE_VALUE, "Saugzug", "%", 1, Sine(60.0, 30.0, 1800.0, floor = 0.0)),
+    (TYPE_VALUE, "Prim.Luft", "%", 1, Sine(40.0, 20.0, 1800.0, floor = 0.0)),
+    (TYPE_VALUE, "Sek.Luft", "%", 1, Sine(50.0, 20.0, 1800.0, floor = 0.0)),
+    (TYPE_VALUE, "Rest-O2", "%", 10, RandomWalk(8.0, 0.2, 4.0, 21.0)),
+    (TYPE_VALUE, "Puffert.ob", "°", 2, Sine(65.0, 10.0, 7200.0)),
+    (TYPE_VALUE, "Puffert.mi", "°", 2, Sine(50.0, 10.0, 7200.0)),
+    (TYPE_VALUE, "Puffert.un", "°", 2, Sine(35.0, 10.0, 7200.0)),
+    (TYPE_VALUE, "Außentemp", "°", 2, Sine(5.0, 5.0, 86400.0)),
+    (TYPE_VALUE, "Vorlauft.1sw", "°", 2, Constant(40.0)),
+    (TYPE_VALUE, "Vorlauft.1", "°", 2, Sine(39.0, 2.0, 600.0)),
+    (TYPE_VALUE, "Vorlauft.2sw", "°", 2, Constant(35.0)),
+    (TYPE_VALUE, "Vorlauft.2", "°", 2, Sine(34.0, 2.0, 600.0)),
+    (TYPE_VALUE, "Boardtemp.", "°", 2, Constant(38.0))
+]
+
+# MB display texts; string-type parameters carry the index of one of them
+DEFAULT_DISPLAY_TEXTS = [
+    "Störung",
+    "Kessel Aus",
+    "Anheizen",
+    "Heizen",
+    "Feuererhaltung",
+    "Feuer Aus",
+    "Tür offen",
+    "Vorbereitung",
+    "Vorwärmen",
+    "Zünden"
+]
+
+def default_parameters(num_parameters = None, seed = None):
+    parameters = list(DEFAULT_PARAMETERS)
+
+    # filler parameters bring the frame up to the size of a fully configured boiler
+    rng = random.Random(seed)
+    while num_parameters is not None and len(parameters) < num_parameters:
+        parameters.append((TYPE_VALUE, f"Param {len(parameters)}", "°", 10, RandomWalk(20.0, 0.5, 0.0, 100.0, seed = rng.random())))
+    return parameters[:num_parameters]
+
+class LambdatronicSimulator:
+
+    def __init__(self, parameters = None, display_texts = None, host = "127.0.0.1", port = 0, frame_rate = 1.0, time_interval = 60.0,
+                 corrupt_rate = 0.0, disconnect_rate = 0.0, seed = None):
+        self.parameters = parameters if parameters is not None else default_parameters()
+        self.display_texts = display_texts if display_texts is not None else DEFAULT_DISPLAY_TEXTS
+
+        # active errors are sent after login; every change is appended to the error log,
+        # from which each connection forwards the M3 frames it has not sent yet
+        self.errors = {}
+        self.error_log = []
+
+        self.host = host
+        self.port = port
+        self.frame_rate = frame_rate
+        self.time_interval = time_interval
+        self.corrupt_rate = corrupt_rate
+        self.disconnect_rate = disconnect_rate
+        self.rng = random.Random(seed)
+
+        self.stats = {"connections": 0, "frames": 0, "acks": 0, "corrupted": 0, "disconnects": 0}
+        self.start_time = time.monotonic()
+        self.server = None
+        self.thread = None
+
+    def metadata_frames(self):
+        frames = []
+        for index, (parameter_type, name, unit, divisor, waveform) in enumerate(self.parameters):
+            frames.append(make_frame(b"MA", struct.pack(">BHH", parameter_type, index, 0) + name.encode("cp850")))
+        for index, text in enumerate(self.display_texts):
+            frames.append(make_frame(b"MB", struct.pack(">H", index) + text.encode("cp850")))
+        for index, (parameter_type, name, unit, divisor, waveform) in enumerate(self.parameters):
+            num_decimals = len(str(divisor)) - 1
+            frames.append(make_frame(b"MC", struct.pack(">H", index) + unit.encode("cp850") + struct.pack(">BHH", num_decimals, divisor, 0)))
+        return frames
+
+    def time_frame(self):
+        now = datetime.datetime.now()
+        return make_frame(b"M2", bytes([_bcd(now.second), _bcd(now.minute), _bcd(now.hour), _bcd(now.day),
+                                        _bcd(now.month), now.isoweekday(), _bcd(now.year % 100)]))
+
+    def error_frame(self, number, state, text):
+        now = datetime.datetime.now()
+        return make_frame(b"M3", struct.pack(">HB", number, state) +
+                          bytes([_bcd(now.second), _bcd(now.minute), _bcd(now.hour), _bcd(now.day),
+                                 _bcd(now.month), now.isoweekday(), _bcd(now.year % 100)]) + text.encode("cp850"))
+
+    def set_error(self, number, text, state = ERROR_ACTIVE):
+        self.errors[number] = (state, text)
+        self.error_log.append(self.error_frame(number, state, text))
+
+    def clear_error(self, number):
+        state, text = self.errors.pop(number)
+        self.error_log.append(self.error_frame(number, ERROR_GONE, text))
+
+    def measurement_frame(self):
+        t = time.monotonic() - self.start_time
+        raw = [max(-0x8000, min(0x7FFF, int(round(waveform(t, self) * divisor))))
+               for parameter_type, name, unit, divisor, waveform in self.parameters]
+        return make_frame(b"M1", struct.pack(">{}h".format(len(raw)), *raw))
+
+    def _make_handler(self):
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def send(self, frame):
+                if sim.rng.random() < sim.corrupt_rate:
+                    frame = bytearray(frame)
+                    frame[sim.rng.randrange(len(frame))] ^= 1 << sim.rng.randrange(8)
+                    sim.stats["corrupted"] += 1
+
+                self.request.sendall(frame)
+                sim.stats["frames"] += 1
+
+                if sim.rng.random() < sim.disconnect_rate:
+                    sim.stats["disconnects"] += 1
+                    raise ConnectionError("Injected disconnect")
+
+            def handle_frame(self, frame):
+                cmd, payload = frame[:2], frame[3:-2]
+                if payload == ACK_PAYLOAD:
+                    sim.stats["acks"] += 1
+                    return
+
+                self.send(make_frame(cmd, ACK_PAYLOAD))
+                if cmd == LOGIN:
+                    for metadata_frame in sim.metadata_frames():
+                        self.send(metadata_frame)
+                    self.error_position = len(sim.error_log)
+                    for number, (state, text) in list(sim.errors.items()):
+                        self.send(sim.error_frame(number, state, text))
+                    self.send(sim.time_frame())
+                    self.next_time_frame = time.monotonic() + sim.time_interval
+                elif cmd == REQUEST_STATUS:
+                    self.next_measurement = time.monotonic()
+
+            def handle(self):
+                sim.stats["connections"] += 1
+                self.next_measurement = None
+                self.next_time_frame = None
+                self.error_position = None
+                buffer = bytearray()
+
+                try:
+                    while True:
+                        deadlines = [deadline for deadline in (self.next_measurement, self.next_time_frame) if deadline is not None]
+                        timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else 1.0
+
+                        if select.select([self.request], [], [], timeout)[0]:
+                            data = self.request.recv(4096)
+                            if not data:
+                                return
+                            buffer += data
+                            frames, consumed = split_frames(buffer)
+                            del buffer[:consumed]
+                            for frame in frames:
+                                self.handle_frame(frame)
+
+                        now = time.monotonic()
+                        if self.next_measurement is not None and now >= self.next_measurement:
+                            self.send(sim.measurement_frame())
+                            self.next_measurement = max(self.next_measurement + 1.0 / sim.frame_rate, now - 1.0)
+                        if self.next_time_frame is not None and now >= self.next_time_frame:
+                            self.send(sim.time_frame())
+                            self.next_time_frame = now + sim.time_interval
+                        if self.error_position is not None:
+                            while self.error_position < len(sim.error_log):
+                                self.send(sim.error_log[self.error_position])
+                                self.error_position += 1
+                except (ConnectionError, OSError):
+                    return
+
+        return Handler
+
+    def start(self):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), self._make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(10)
+                print("{}:{} {}".format(self.host, self.port, self.stats))
+        except KeyboardInterrupt:
+            self.stop()
+
+class SessionRecorder:
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(RECORDING_MAGIC)
+        self.start_time = time.monotonic()
+
+    def record(self, direction, data):
+        for pos in range(0, len(data), 0xFFFF):
+            chunk = data[pos : pos + 0xFFFF]
+            timestamp_ms = int((time.monotonic() - self.start_time) * 1000)
+            self.file.write(RECORD_HEADER.pack(timestamp_ms, direction, len(chunk)) + chunk)
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path):
+    # yields (seconds since start, direction, data) for every recorded chunk
+    with open(path, "rb") as recording:
+        if recording.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a Froeling recording")
+
+        while True:
+            header = recording.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp_ms, direction, length = RECORD_HEADER.unpack(header)
+            yield timestamp_ms / 1000.0, direction, recording.read(length)
+
+def recorded_frames(path):
+    # yields (seconds since start, frame) for every complete frame the boiler sent
+    buffer = bytearray()
+    for timestamp, direction, data in read_recording(path):
+        if direction != FROM_BOILER:
+            continue
+        buffer += data
+        frames, consumed = split_frames(buffer)
+        del buffer[:consumed]
+        for frame in frames:
+            yield timestamp, frame
+
+def record_session(boiler_host, boiler_port, path, host = "127.0.0.1", port = 2323):
+    # transparent proxy between one client and the boiler that records all traffic
+    listener = socket.create_server((host, port))
+    print(f"Recording to {path}, point the client at {host}:{port}")
+    client, address = listener.accept()
+    boiler = socket.create_connection((boiler_host, boiler_port))
+    recorder = SessionRecorder(path)
+
+    peers = {client: (boiler, TO_BOILER), boiler: (client, FROM_BOILER)}
+    try:
+        while True:
+            for sock in select.select(list(peers), [], [])[0]:
+                data = sock.recv(4096)
+                if not data:
+                    return
+                other, direction = peers[sock]
+                recorder.record(direction, data)
+                other.sendall(data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        client.close()
+        boiler.close()
+        listener.close()
+
+def replay_session(path, host = "127.0.0.1", port = 2323, speed = 1.0):
+    # serves the boiler side of a recording to one client; speed 0 replays as fast as possible
+    listener = socket.create_server((host, port))
+    print(f"Replaying {path} on {host}:{port}")
+    client, address = listener.accept()
+
+    # recordings start with the client's login, give the client a moment to send it
+    select.select([client], [], [], 5.0)
+
+    start_time = time.monotonic()
+    num_bytes = 0
+    try:
+        for timestamp, direction, data in read_recording(path):
+            if direction != FROM_BOILER:
+                continue
+            if speed > 0:
+                time.sleep(max(0.0, start_time + timestamp / speed - time.monotonic()))
+            client.sendall(data)
+            num_bytes += len(data)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        print(f"Replayed {num_bytes} bytes in {time.monotonic() - start_time:.2f} s")
+        client.close()
+        listener.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Simulator, recorder and replayer for the Froeling Lambdatronic S3100 protocol")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    serve_parser = subparsers.add_parser("serve", help = "simulate a boiler")
+    serve_parser.add_argument("--host", default = "127.0.0.1")
+    serve_parser.add_argument("--port", type = int, default = 2323)
+    serve_parser.add_argument("--frame-rate", type = float, default = 1.0, help = "M1 frames per second")
+    serve_parser.add_argument("--parameters", type = int, default = None, help = "number of parameters per M1 frame")
+    serve_parser.add_argument("--corrupt", type = float, default = 0.0, help = "fraction of frames with a flipped bit")
+    serve_parser.add_argument("--disconnect", type = float, default = 0.0, help = "probability of closing the connection after a frame")
+    serve_parser.add_argument("--seed", type = int, default = None)
+
+    record_parser = subparsers.add_parser("record", help = "record a session with a real boiler through a proxy")
+    record_parser.add_argument("--boiler", default = "192.168.1.147:23")
+    record_parser.add_argument("--host", default = "127.0.0.1")
+    record_parser.add_argument("--port", type = int, default = 2323)
+    record_parser.add_argument("--out", required = True)
+
+    replay_parser = subparsers.add_parser("replay", help = "replay a recorded session")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--host", default = "127.0.0.1")
+    replay_parser.add_argument("--port", type = int, default = 2323)
+    replay_parser.add_argument("--speed", type = float, default = 1.0, help = "speed-up factor, 0 for as fast as possible")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        sim = LambdatronicSimulator(parameters = default_parameters(args.parameters, args.seed), host = args.host, port = args.port,
+                                    frame_rate = args.frame_rate, corrupt_rate = args.corrupt,
+                                    disconnect_rate = args.disconnect, seed = args.seed)
+        print(f"Serving simulated boiler on {args.host}:{args.port}")
+        sim.serve_forever()
+    elif args.command == "record":
+        boiler_host, boiler_port = args.boiler.rsplit(":", 1)
+        record_session(boiler_host, int(boiler_port), args.out, host = args.host, port = args.port)
+    else:
+        replay_session(args.recording, host = args.host, port = args.port, speed = args.speed)
@@ -1,35 +1,93 @@
 from pyModbusTCP.client import ModbusClient
-import time, timeutils
+from modbusutils import ReadPlanner, RegisterMap, TracedModbusClient
+from tracing import get_tracer
+import socket, threading, timeutils
+
+CHANNEL_BASE_ADDR = 0x1000
+CHANNEL_STRIDE = 0x28
+
+# layout of one channel block: (byte offset, type, scale, key)
+CHANNEL_FIELDS = [
+    (0x07, "U8", None, "port_number"),
+    (0x08, "U16", 0.1, "pv_voltage_V"),
+    (0x0A, "U16", 0.01, "pv_current_A"),
+    (0x0C, "U16", 0.1, "grid_voltage_V"),
+    (0x0E, "U16", 0.01, "grid_frequency_Hz"),
+    (0x10, "U16", 1e-4, "pv_power_kW"),
+    (0x12, "U16", 1e-3, "energy_today_kWh"),
+    (0x14, "U32", 1e-3, "energy_total_kWh"),
+    (0x18, "L16", 0.1, "temperature_deg"),
+    (0x1A, "U16", None, "operating_status"),
+    (0x1C, "U16", None, "alarm_code"),
+    (0x1E, "U16", None, "alarm_count"),
+    (0x20, "U8", None, "link_status")
+]
+
+def channel_registers(channels):
+    return {f"channel_{channel}": [(CHANNEL_BASE_ADDR + CHANNEL_STRIDE * channel + offset, register_type, scale, key)
+                                   for offset, register_type, scale, key in CHANNEL_FIELDS]
+            for channel in channels}
+
+# inverters behind one DTU and the DTU channels (MPPT ports) that belong to each of them
+DEFAULT_INVERTERS = [
+    {"name": "inverter_0", "channels": [0, 1, 2, 3]},
+    {"name": "inverter_1", "channels": [4, 5, 6, 7]}
+]
 
 class HoymilesInverter:
 
-    def __init__(self, host, port):
-        self.c = ModbusClient(host = host, port = port, unit_id = 1,
-                              auto_open = True, debug = False, timeout = 3)
-
-        self.power_status = {
-            "inverter_0_power_kW": 0.0,
-            "inverter_1_power_kW": 0.0,
-            "last_updated": "Never"
-        }
-
-        self.temperature_status = {
-            "temp_inverter_0_deg": 0.0,
-            "temp_inverter_1_deg": 0.0,
-            "last_updated": "Never"
-        }
+    def __init__(self, host, port, inverters = None, max_read_block = 80, max_read_gap = 20):
+        self.tracer = get_tracer(f"hoymiles_{host}_{port}")
+        self.c = TracedModbusClient(self.tracer, host = host, port = port, unit_id = 1,
+                                    auto_open = True, debug = False, timeout = 3)
+
+        # polls, probes and power limit writes come from different threads and share one socket
+        self.io_lock = threading.Lock()
+
+        self.inverters = inverters if inverters is not None else DEFAULT_INVERTERS
+        self.channels = sorted(set(channel for inverter in self.inverters for channel in inverter["channels"]))
+
+        # the DTU registers are byte-addressed, every channel owns a block of 0x28 addresses (20 words);
+        # consecutive channel blocks are swept in reads of up to max_read_block words
+        self.read_planner = ReadPlanner(max_gap = max_read_gap, max_block = max_read_block, bytes_per_address = 1)
+
+        # per-channel snapshot of everything in the channel block, keyed "channel_<n>"
+        self.channel_status = {f"channel_{channel}": {key: 0 for offset, register_type, scale, key in CHANNEL_FIELDS}
+                               for channel in self.channels}
+        self.channel_map = RegisterMap(channel_registers(self.channels), self.read_planner)
+
+        self.power_status = {f"{inverter['name']}_power_kW": 0.0 for inverter in self.inverters}
+        self.power_status["last_updated"] = "Never"
+
+        self.temperature_status = {f"temp_{inverter['name']}_deg": 0.0 for inverter in self.inverters}
+        self.temperature_status["last_updated"] = "Never"
     
+    def update_status(self):
+        # one sweep over all channel blocks refreshes every channel field together
+        self.channel_map.read(self.read_register, self.channel_status)
+        last_updated = timeutils.get_current_timestamp()
+
+        for channel_status in self.channel_status.values():
+            channel_status["last_updated"] = last_updated
+
+        for inverter in self.inverters:
+            self.power_status[f"{inverter['name']}_power_kW"] = sum(self.get_channel_status(channel)["pv_power_kW"] for channel in inverter["channels"])
+            self.temperature_status[f"temp_{inverter['name']}_deg"] = self.get_channel_status(inverter["channels"][0])["temperature_deg"]
+
+        self.power_status["last_updated"] = last_updated
+        self.temperature_status["last_updated"] = last_updated
+
+    def get_channel_status(self, channel):
+        return self.channel_status[f"channel_{channel}"]
+
+    def get_total_power_kW(self):
+        return sum(self.power_status[f"{inverter['name']}_power_kW"] for inverter in self.inverters)
+
     def update_power_status(self):
-        inverter_0_data = [self.get_channel_data(channel, 0x10, 1)[0] for channel in range(0, 4)]
-        inverter_1_data = [self.get_channel_data(channel, 0x10, 1)[0] for channel in range(4, 8)]        
-        self.power_status["inverter_0_power_kW"] = sum(inverter_0_data) * 1e-4
-        self.power_status["inverter_1_power_kW"] = sum(inverter_1_data) * 1e-4
-        self.power_status["last_updated"] = timeutils.get_current_timestamp()
+        self.update_status()
 
     def update_temperature_status(self):
-        self.temperature_status["temp_inverter_0_deg"] = self.word_to_L16(self.get_channel_data(0, 0x18, 1)[0]) * 0.1
-        self.temperature_status["temp_inverter_1_deg"] = self.word_to_L16(self.get_channel_data(4, 0x18, 1)[0]) * 0.1
-        self.temperature_status["last_updated"] = timeutils.get_current_timestamp()
+        self.update_status()
 
     def word_to_L16(self, word):
         return int.from_bytes(word.to_bytes(2, byteorder = "big", signed = False), byteorder = "big", signed = True)
@@ -39,7 +97,7 @@ class HoymilesInverter:
         return self.read_register(global_addr, num_words)
 
     def limit_power(self, percent):        
-        self.write_single_dtu_register(0xC001, int(percent * 65535 / 100.0))
+        return self.write_single_dtu_register(0xC001, int(percent * 65535 / 100.0))
     
     def write_single_dtu_register(self, addr, val):
         import struct        
@@ -47,27 +105,56 @@ class HoymilesInverter:
             raise ValueError('bit_addr out of range (valid from 0 to 65535)')
         try:
             tx_pdu = struct.pack('>BHH', 0x05, addr, val)
-            rx_pdu = self.c._req_pdu(tx_pdu=bytes(tx_pdu), rx_min_len=5)
+            with self.io_lock:
+                rx_pdu = self.c._req_pdu(tx_pdu=bytes(tx_pdu), rx_min_len=5)
             resp_coil_addr, resp_coil_value = struct.unpack('>HH', rx_pdu[1:5])
             if (resp_coil_addr != addr) or (resp_coil_value != val):
                 return False
             return True
         except ModbusClient._InternalError as e:
+            self.tracer.record_error(f"write 0x{addr:04X}: {e}")
             self.c._req_except_handler(e)
             return False
         
     def read_register(self, addr, num_words, verbose = False, timeout = 0.2):
         while True:
-            words = self.c.read_holding_registers(addr, num_words)
+            with self.io_lock:
+                words = self.c.read_holding_registers(addr, num_words)
             if words is None:
+                self.tracer.record_error(f"read 0x{addr:04X} ({num_words} words): {self.c.last_error_as_txt}")
                 raise RuntimeError("Error: no data received")
             return words
 
-    def power_cycle_dtu(self, hass_instance, switch_name = "switch.philipp"):
+    def reconnect(self):
+        # without io_lock, which a request stuck on the dead connection may still hold: shutting the socket down
+        # wakes that request up, and auto_open re-establishes the connection on the next one
+        sock = self.c._sock
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def probe(self, timeout = 1.0):
+        # a short one-word read with its own timeout, so that probing never blocks for long;
+        # a request still holding the connection counts as a failed probe
+        if not self.io_lock.acquire(timeout = timeout):
+            return False
+        try:
+            regular_timeout = self.c.timeout
+            self.c.timeout = timeout
+            try:
+                return self.c.read_holding_registers(CHANNEL_BASE_ADDR, 1) is not None
+            finally:
+                self.c.timeout = regular_timeout
+        finally:
+            self.io_lock.release()
+
+    def power_cycle_dtu(self, hass_instance, switch_name = "switch.philipp", off_time = 1):
+        # the switch is turned back on by the scheduler instead of sleeping in the callback thread
         switch = hass_instance.get_entity(switch_name)
         switch.turn_off()
-        time.sleep(1)
-        switch.turn_on()
+        hass_instance.run_in(lambda kwargs: switch.turn_on(), off_time)
                 
 if __name__ == "__main__":
 
@@ -75,7 +162,6 @@ if __name__ == "__main__":
         
     while True:
         
-        hoymiles_inverter.update_power_status()
+        hoymiles_inverter.update_status()
         print(hoymiles_inverter.power_status)
-        hoymiles_inverter.update_temperature_status()
         print(hoymiles_inverter.temperature_status)
@@ -1,114 +1,329 @@
 import appdaemon.plugins.hass.hassapi as hass
-import time, timeutils
+import time, timeutils, tracing
+from concurrent.futures import ThreadPoolExecutor, wait
 from hoymiles import HoymilesInverter
+from export_limiter import ExportLimiter
+
+DEFAULT_DTUS = [
+    {
+        "name": "dtu_0",
+        "host": "192.168.1.136",
+        "port": 502,
+        "power_switch": "switch.philipp",
+        "inverters": [
+            {"name": "inverter_0", "friendly_name": "Gaupe Ost", "channels": [0, 1, 2, 3]},
+            {"name": "inverter_1", "friendly_name": "Gaupe West", "channels": [4, 5, 6, 7]}
+        ]
+    }
+]
+
+CHANNEL_FIELD_UNITS = {
+    "pv_voltage_V": ("V", "voltage"),
+    "pv_current_A": ("A", "current"),
+    "grid_voltage_V": ("V", "voltage"),
+    "grid_frequency_Hz": ("Hz", "frequency"),
+    "pv_power_kW": ("kW", "power"),
+    "energy_today_kWh": ("kWh", "energy"),
+    "energy_total_kWh": ("kWh", "energy"),
+    "temperature_deg": ("°C", "temperature"),
+    "operating_status": ("", None),
+    "alarm_code": ("", None),
+    "alarm_count": ("", None),
+    "link_status": ("", None)
+}
+
+# recovery ladder: (tier, time budget in seconds, delay before the first probe, interval between probes)
+RECOVERY_TIERS = [
+    ("reconnect", 5, 0, 1),
+    ("reprobe", 20, 2, 2),
+    ("power_cycle", 90, 10, 5)
+]
 
 class HoymilesMgr(hass.Hass):
 
     def initialize(self):
-        self.run_in(self.connect_to_inverter, 10)
+
+        # topology DTUs -> inverters -> channels, taken from the app config
+        self.dtu_configs = self.args.get("dtus", DEFAULT_DTUS)
+
+        inverter_names = [inverter["name"] for dtu_config in self.dtu_configs for inverter in dtu_config["inverters"]]
+        if len(inverter_names) != len(set(inverter_names)):
+            raise ValueError("Hoymiles inverter names must be unique across all DTUs")
+
+        # DTUs are polled concurrently, so the refresh latency stays flat as DTUs are added
+        self.executor = ThreadPoolExecutor(max_workers = min(len(self.dtu_configs), self.args.get("max_workers", 4)))
+        self.poll_timeout = self.args.get("poll_timeout", 10)
+
+        # per-channel fields published in addition to the per-inverter sums
+        self.channel_fields = self.args.get("channel_fields", [])
+        unknown_fields = set(self.channel_fields) - set(CHANNEL_FIELD_UNITS)
+        if unknown_fields:
+            raise ValueError(f"Unknown Hoymiles channel fields: {sorted(unknown_fields)}")
+
+        self.probe_timeout = self.args.get("probe_timeout", 1.0)
+        self.recovery_cooldown = self.args.get("recovery_cooldown", 60)
+
+        # DTUs in recovery: name -> {"tier": index into RECOVERY_TIERS, "deadline": monotonic time, "reason": str}
+        self.recovery = {}
+
+        # zero-export control: the DTU power limit follows the grid power reported by solar_mgr
+        self.export_limiter = None
+        self.export_loop_latency_ms = 0.0
+        if self.args.get("export_limit_kW") is not None:
+            rated_power_kW = sum(inverter.get("rated_power_kW", 1.6) for dtu_config in self.dtu_configs for inverter in dtu_config["inverters"])
+            self.export_limiter = ExportLimiter(export_limit_kW = self.args["export_limit_kW"],
+                                                rated_power_kW = rated_power_kW,
+                                                margin_kW = self.args.get("export_margin_kW", 0.1),
+                                                deadband_kW = self.args.get("export_deadband_kW", 0.05),
+                                                max_ramp_kW_per_s = self.args.get("export_max_ramp_kW_per_s", 0.2),
+                                                min_write_interval = self.args.get("export_min_write_interval", 2.0),
+                                                battery_feed_forward = self.args.get("export_battery_feed_forward", 0.5))
+            self.listen_event(self.limit_export, "sofar_power_update")
+
+        # fire "dump_trace" (optionally with name, path and last) to dump the Modbus traces of the DTUs
+        self.listen_event(self.dump_trace, "dump_trace")
+
+        self.connect_to_inverter({})
+
+    def terminate(self):
+        self.executor.shutdown(wait = False)
 
     def connect_to_inverter(self, kwargs):
-        
-        self.hoymiles_inverter = HoymilesInverter(host = '192.168.1.136', port = 502)             
-        self.hoymiles_inverter.power_cycle_dtu(self)
-
-        self.publish_message(var_name = "hoymiles_last_dtu_reset",
-                             friendly_name = "Letzter Reset der DTU",
-                             msg_text = timeutils.get_current_timestamp())
-        
-        self.run_in(self.schedule_callbacks, 15)
-        
+
+        self.dtus = {}
+        for dtu_config in self.dtu_configs:
+            self.dtus[dtu_config["name"]] = HoymilesInverter(host = dtu_config["host"], port = dtu_config.get("port", 502),
+                                                             inverters = dtu_config["inverters"])
+
+        # polling starts right away, DTUs that do not answer enter the recovery ladder
+        self.schedule_callbacks({})
+
     def schedule_callbacks(self, kwargs):
-        
-        self.run_every(self.update_power_status, "now", 4)
-        self.run_every(self.update_aux_status, "now", 10)
+
+        self.run_every(self.update_status, "now", 4)
         self.run_every(self.publish_measurements, "now", 4)
         self.run_every(self.data_integrity_watchdog, "now", 4)
 
-    def data_integrity_watchdog(self, kwargs):
+    def _sun_shines(self):
+        sun_state = self.get_entity("sun.sun").get_state(attribute = "state")
+        return sun_state == "above_horizon"
+
+    def _dtu_is_anomalous(self, dtu):
 
         def _is_anomalous_val(val):
             return abs(val) < 1e-3
 
-        def _sun_shines():
-            sun_state = self.get_entity("sun.sun").get_state(attribute = "state")
-            return sun_state == "above_horizon"
-        
-        if _sun_shines() and \
-           _is_anomalous_val(self.hoymiles_inverter.power_status["inverter_0_power_kW"]) and \
-           _is_anomalous_val(self.hoymiles_inverter.power_status["inverter_1_power_kW"]) and \
-           _is_anomalous_val(self.hoymiles_inverter.temperature_status["temp_inverter_0_deg"]) and \
-           _is_anomalous_val(self.hoymiles_inverter.temperature_status["temp_inverter_1_deg"]):
-            self.schedule_restart()
-            
-    def schedule_restart(self):
-
-        self.hoymiles_inverter.power_status["inverter_0_power_kW"] = 0.0
-        self.hoymiles_inverter.power_status["inverter_1_power_kW"] = 0.0
-        self.hoymiles_inverter.power_status["last_updated"] = "in_restart"
-        self.hoymiles_inverter.temperature_status["temp_inverter_0_deg"] = 0.0
-        self.hoymiles_inverter.temperature_status["temp_inverter_1_deg"] = 0.0
-        self.hoymiles_inverter.temperature_status["last_updated"] = "in_restart"
-        self.publish_measurements_hoymiles()
-        self.restart_app("hoymiles_mgr")
-        
-    def update_power_status(self, kwargs):
-        try:
-            self.hoymiles_inverter.update_power_status()
-        except:
-            self.schedule_restart()
+        return all(_is_anomalous_val(dtu.power_status[f"{inverter['name']}_power_kW"]) and
+                   _is_anomalous_val(dtu.temperature_status[f"temp_{inverter['name']}_deg"])
+                   for inverter in dtu.inverters)
+
+    def data_integrity_watchdog(self, kwargs):
+
+        if not self._sun_shines():
+            return
+
+        for name, dtu in self.dtus.items():
+            if name not in self.recovery and self._dtu_is_anomalous(dtu):
+                self.start_recovery(name, reason = "anomalous data")
+
+    def start_recovery(self, name, reason):
+
+        print("{}: Hoymiles {} failed ({}), starting recovery.".format(timeutils.get_current_timestamp(), name, reason))
+
+        dtu = self.dtus[name]
+        print(dtu.tracer.format(last = 20))
+        for key in dtu.power_status:
+            dtu.power_status[key] = 0.0
+        for key in dtu.temperature_status:
+            dtu.temperature_status[key] = 0.0
+        dtu.power_status["last_updated"] = "in_recovery"
+        dtu.temperature_status["last_updated"] = "in_recovery"
+
+        self.recovery[name] = {"tier": -1, "deadline": 0.0, "reason": reason}
+        self.enter_recovery_tier(name, 0)
+
+    def enter_recovery_tier(self, name, tier):
+
+        tier_name, budget, first_probe_delay, probe_interval = RECOVERY_TIERS[tier]
+        self.recovery[name]["tier"] = tier
+        self.recovery[name]["deadline"] = time.monotonic() + budget
+        self.publish_recovery_status(name, tier_name)
+
+        dtu = self.dtus[name]
+        dtu.reconnect()
+
+        if tier_name == "power_cycle":
+            dtu_config = next(dtu_config for dtu_config in self.dtu_configs if dtu_config["name"] == name)
+            dtu.power_cycle_dtu(self, switch_name = dtu_config.get("power_switch", "switch.philipp"))
+            self.publish_message(var_name = "hoymiles_last_dtu_reset",
+                                 friendly_name = "Letzter Reset der DTU",
+                                 msg_text = timeutils.get_current_timestamp())
+
+        self.run_in(self.recovery_probe, first_probe_delay, dtu_name = name)
+
+    def recovery_probe(self, kwargs):
 
-    def update_aux_status(self, kwargs):
+        name = kwargs["dtu_name"]
+        if name not in self.recovery:
+            return
+
+        tier = self.recovery[name]["tier"]
+        if self._dtu_recovered(name):
+            print("{}: Hoymiles {} recovered in tier '{}'.".format(timeutils.get_current_timestamp(), name, RECOVERY_TIERS[tier][0]))
+            del self.recovery[name]
+            self.publish_recovery_status(name, "ok")
+            return
+
+        if time.monotonic() < self.recovery[name]["deadline"]:
+            self.run_in(self.recovery_probe, RECOVERY_TIERS[tier][3], dtu_name = name)
+        elif tier + 1 < len(RECOVERY_TIERS):
+            self.enter_recovery_tier(name, tier + 1)
+        else:
+            # ladder exhausted: start over after a cool-down instead of hammering the DTU
+            self.publish_recovery_status(name, "failed")
+            self.run_in(lambda kwargs: self.enter_recovery_tier(name, 0), self.recovery_cooldown)
+
+    def _dtu_recovered(self, name):
+
+        dtu = self.dtus[name]
         try:
-            self.hoymiles_inverter.update_temperature_status()
-        except:
-            self.schedule_restart()
+            if not dtu.probe(timeout = self.probe_timeout):
+                return False
+            dtu.update_status()
+        except (ConnectionError, RuntimeError, OSError):
+            return False
+
+        # a DTU that answers with all-zero data in daylight has not recovered yet
+        return not (self._sun_shines() and self._dtu_is_anomalous(dtu))
+
+    def publish_recovery_status(self, name, status):
+        self.publish_message(var_name = f"hoymiles_{name}_recovery",
+                             friendly_name = f"Wiederherstellung {name}",
+                             msg_text = status)
+
+    def update_status(self, kwargs):
+
+        # DTUs in recovery are left to the recovery ladder
+        active = {name: dtu for name, dtu in self.dtus.items() if name not in self.recovery}
+        futures = {name: self.executor.submit(dtu.update_status) for name, dtu in active.items()}
+        done, not_done = wait(futures.values(), timeout = self.poll_timeout)
+
+        for name, future in futures.items():
+            if future in not_done:
+                self.start_recovery(name, reason = "poll timeout")
+            elif future.exception() is not None:
+                self.start_recovery(name, reason = repr(future.exception()))
+
+    def limit_export(self, event_name, data, kwargs):
+
+        percent = self.export_limiter.update(grid_power_kW = data["grid_power_kW"],
+                                             hoymiles_power_kW = sum(dtu.get_total_power_kW() for dtu in self.dtus.values()),
+                                             battery_power_charge_kW = data["battery_power_charge_kW"])
+        if percent is None:
+            return
+
+        # DTUs in recovery keep their last limit until they answer again
+        futures = [self.executor.submit(dtu.limit_power, percent) for name, dtu in self.dtus.items() if name not in self.recovery]
+        done, not_done = wait(futures, timeout = self.poll_timeout)
+
+        if not_done or any(future.exception() is not None or not future.result() for future in futures):
+            print("{}: Hoymiles power limit write ({} %) failed.".format(timeutils.get_current_timestamp(), percent))
+            return
+
+        self.export_limiter.commit(percent)
+
+        # from the Sofar measurement to the acknowledged limit write
+        self.export_loop_latency_ms = 1000.0 * (time.time() - data["timestamp"])
+
+    def dump_trace(self, event_name, data, kwargs):
+        names = [dtu.tracer.name for dtu in self.dtus.values() if data.get("name") in (None, dtu.tracer.name)]
+        if names:
+            tracing.dump(names = names, path = data.get("path"), last = data.get("last"))
 
     def publish_measurements(self, kwargs):
         self.publish_measurements_hoymiles()
+        if self.export_limiter is not None:
+            self.publish_measurements_export_limit()
 
     def publish_measurements_hoymiles(self):
 
-        self.publish_measurement(var_name = "hoymiles_inverter_0_power",
-                                 friendly_name = "Gaupe Ost Ausgangsleistung",
-                                 value = self.disp_format(self.hoymiles_inverter.power_status["inverter_0_power_kW"]),
-                                 unit = "kW",
-                                 meas_type = "power")
+        for dtu_config in self.dtu_configs:
+            dtu = self.dtus[dtu_config["name"]]
+
+            for inverter in dtu_config["inverters"]:
+                friendly_name = inverter.get("friendly_name", inverter["name"])
+
+                self.publish_measurement(var_name = f"hoymiles_{inverter['name']}_power",
+                                         friendly_name = f"{friendly_name} Ausgangsleistung",
+                                         value = self.disp_format(dtu.power_status[f"{inverter['name']}_power_kW"]),
+                                         unit = "kW",
+                                         meas_type = "power")
+
+                self.publish_measurement(var_name = f"hoymiles_{inverter['name']}_temp_deg",
+                                         friendly_name = f"{friendly_name} Temperatur",
+                                         value = self.disp_format(dtu.temperature_status[f"temp_{inverter['name']}_deg"]),
+                                         unit = "°C",
+                                         meas_type = "power")
+
+                for channel in inverter["channels"]:
+                    channel_status = dtu.get_channel_status(channel)
+                    for field in self.channel_fields:
+                        unit, meas_type = CHANNEL_FIELD_UNITS[field]
+                        self.publish_measurement(var_name = f"hoymiles_{inverter['name']}_channel_{channel}_{field.lower()}",
+                                                 friendly_name = f"{friendly_name} Kanal {channel} {field}",
+                                                 value = self.disp_format(channel_status[field]),
+                                                 unit = unit,
+                                                 meas_type = meas_type)
 
-        self.publish_measurement(var_name = "hoymiles_inverter_1_power",
-                                 friendly_name = "Gaupe West Ausgangsleistung",
-                                 value = self.disp_format(self.hoymiles_inverter.power_status["inverter_1_power_kW"]),
+            self.publish_message(var_name = f"hoymiles_{dtu_config['name']}_lastdata",
+                                 friendly_name = f"Letzte Aktualisierung {dtu_config['name']}",
+                                 msg_text = dtu.power_status["last_updated"])
+
+        self.publish_measurement(var_name = "hoymiles_total_power",
+                                 friendly_name = "Hoymiles Ausgangsleistung gesamt",
+                                 value = self.disp_format(sum(dtu.get_total_power_kW() for dtu in self.dtus.values())),
                                  unit = "kW",
                                  meas_type = "power")
 
+        # kept for existing dashboards: the first DTU's update times
+        first_dtu = self.dtus[self.dtu_configs[0]["name"]]
+
         self.publish_message(var_name = "hoymiles_power_lastdata",
                              friendly_name = "Letzte Aktualisierung der Leistungsdaten",
-                             msg_text = self.hoymiles_inverter.power_status["last_updated"])
+                             msg_text = first_dtu.power_status["last_updated"])
 
-        self.publish_measurement(var_name = "hoymiles_inverter_0_temp_deg",
-                                 friendly_name = "Gaupe Ost Temperatur",
-                                 value = self.disp_format(self.hoymiles_inverter.temperature_status["temp_inverter_0_deg"]),
-                                 unit = "°C",
-                                 meas_type = "power")
+        self.publish_message(var_name = "hoymiles_temp_lastdata",
+                             friendly_name = "Letzte Aktualisierung der Temperaturdaten",
+                             msg_text = first_dtu.temperature_status["last_updated"])
+
+    def publish_measurements_export_limit(self):
 
-        self.publish_measurement(var_name = "hoymiles_inverter_1_temp_deg",
-                                 friendly_name = "Gaupe West Temperatur",
-                                 value = self.disp_format(self.hoymiles_inverter.temperature_status["temp_inverter_1_deg"]),
-                                 unit = "°C",
+        self.publish_measurement(var_name = "hoymiles_export_power_limit",
+                                 friendly_name = "Hoymiles Leistungsbegrenzung",
+                                 value = self.disp_format(self.export_limiter.limit_percent or 100.0),
+                                 unit = "%",
+                                 meas_type = "power_factor")
+
+        self.publish_measurement(var_name = "hoymiles_export_setpoint_error",
+                                 friendly_name = "Einspeisung über Limit",
+                                 value = self.disp_format(self.export_limiter.setpoint_error_kW),
+                                 unit = "kW",
                                  meas_type = "power")
 
-        self.publish_message(var_name = "hoymiles_temp_lastdata",
-                             friendly_name = "Letzte Aktualisierung der Temperaturdaten",
-                             msg_text = self.hoymiles_inverter.temperature_status["last_updated"])
+        self.publish_measurement(var_name = "hoymiles_export_loop_latency",
+                                 friendly_name = "Latenz Einspeiseregelung",
+                                 value = self.disp_format(self.export_loop_latency_ms),
+                                 unit = "ms",
+                                 meas_type = "duration")
 
     def disp_format(self, val):
         return round(val, 2)
-        
+
     def publish_message(self, var_name, friendly_name, msg_text):
         self.set_state(f"sensor.{var_name}",
                        state = msg_text,
                        attributes = {"friendly_name": friendly_name})
-        
+
     def publish_measurement(self, var_name, friendly_name, value, unit, meas_type):
         self.set_state(f"sensor.{var_name}",
                        state = value,
@@ -0,0 +1,93 @@
+import json, os, threading, zlib
+
+class StateJournal:
+
+    def __init__(self, path, compact_after = 1000):
+        # values are kept in memory and persisted as an append-only log of <crc32> <json [key, value]> lines;
+        # the log is rewritten from the current values every compact_after records
+        self.path = path
+        self.compact_after = compact_after
+
+        self.values = {}
+        self.pending = {}
+        self.num_records = 0
+        self.lock = threading.Lock()
+
+        self._load()
+
+        # rewriting right away also drops a record torn by a crash during the last write
+        self.compact()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        num_corrupt = 0
+        with open(self.path, "rb") as journal_file:
+            for line in journal_file:
+                try:
+                    checksum, payload = line.rstrip(b"\n").split(b" ", 1)
+                    if int(checksum, 16) != zlib.crc32(payload):
+                        raise ValueError("checksum mismatch")
+                    key, value = json.loads(payload)
+                except ValueError:
+                    num_corrupt += 1
+                    continue
+                self.values[key] = value
+
+        if num_corrupt > 0:
+            print(f"Journal {self.path}: skipped {num_corrupt} corrupt records.")
+
+    def _encode(self, key, value):
+        payload = json.dumps([key, value]).encode("utf-8")
+        return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+    def get(self, key, default = None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        # only buffered; repeated writes of a key between two flushes end up as one record
+        with self.lock:
+            self.values[key] = value
+            self.pending[key] = value
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            records = b"".join(self._encode(key, value) for key, value in self.pending.items())
+            self.pending.clear()
+
+            try:
+                with open(self.path, "ab") as journal_file:
+                    journal_file.write(records)
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+            except OSError as e:
+                print(f"Journal {self.path} could not be written: {e}")
+                return
+
+            self.num_records += records.count(b"\n")
+            if self.num_records < self.compact_after:
+                return
+
+        self.compact()
+
+    def compact(self):
+        with self.lock:
+            records = b"".join(self._encode(key, value) for key, value in self.values.items())
+            self.pending.clear()
+
+            # write to a temporary file first, so that an interrupted compaction never loses the journal
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "wb") as journal_file:
+                    journal_file.write(records)
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Journal {self.path} could not be compacted: {e}")
+                return
+
+            self.num_records = len(self.values)
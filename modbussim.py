@@ -0,0 +1,278 @@
+import argparse, math, random, select, socketserver, struct, threading, time
+from modbusutils import REGISTER_TYPES
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_COIL = 0x05
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+REGISTER_LIMITS = {
+    "U8": (0, 0xFF),
+    "U16": (0, 0xFFFF),
+    "L16": (-0x8000, 0x7FFF),
+    "U32": (0, 0xFFFFFFFF),
+    "L32": (-0x80000000, 0x7FFFFFFF)
+}
+
+# waveforms are evaluated at read time with the seconds since simulator start
+
+class Constant:
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, t, sim):
+        return self.value
+
+class Sine:
+
+    def __init__(self, offset, amplitude, period, phase = 0.0, floor = None):
+        self.offset = offset
+        self.amplitude = amplitude
+        self.period = period
+        self.phase = phase
+        self.floor = floor
+
+    def __call__(self, t, sim):
+        value = self.offset + self.amplitude * math.sin(2 * math.pi * t / self.period + self.phase)
+        return value if self.floor is None else max(self.floor, value)
+
+class RandomWalk:
+
+    def __init__(self, start, step, low, high, seed = None):
+        self.value = start
+        self.step = step
+        self.low = low
+        self.high = high
+        self.rng = random.Random(seed)
+
+    def __call__(self, t, sim):
+        self.value = min(self.high, max(self.low, self.value + self.rng.uniform(-self.step, self.step)))
+        return self.value
+
+class Limited:
+
+    # scales a waveform by a power limit register (0 - 65535 corresponds to 0 - 100 %)
+    def __init__(self, waveform, limit_addr):
+        self.waveform = waveform
+        self.limit_addr = limit_addr
+
+    def __call__(self, t, sim):
+        return self.waveform(t, sim) * sim.get_word(self.limit_addr, default = 0xFFFF) / 0xFFFF
+
+class DeviceSimulator:
+
+    def __init__(self, fields, bytes_per_address = 2, host = "127.0.0.1", port = 0,
+                 latency = 0.0, jitter = 0.0, loss_rate = 0.0, timeout_rate = 0.0, timeout_delay = 5.0,
+                 pipelining = True, seed = None):
+
+        # fields are (addr, type, scale, waveform) tuples; everything else reads back as written (or 0)
+        self.fields = fields
+        self.bytes_per_address = bytes_per_address
+        self.image = bytearray(0x10000 * bytes_per_address + 2 * 125)
+        self.written = set()
+
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss_rate = loss_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.pipelining = pipelining
+        self.rng = random.Random(seed)
+
+        self.stats = {"requests": 0, "lost": 0, "timeouts": 0, "discarded": 0, "writes": 0}
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.server = None
+        self.thread = None
+
+    def get_word(self, addr, default = 0):
+        if addr not in self.written:
+            return default
+        offset = addr * self.bytes_per_address
+        return struct.unpack_from(">H", self.image, offset)[0]
+
+    def set_words(self, addr, words):
+        offset = addr * self.bytes_per_address
+        struct.pack_into(">{}H".format(len(words)), self.image, offset, *words)
+        self.written.update(range(addr, addr + len(words) * 2 // self.bytes_per_address))
+
+    def _refresh_fields(self, addr, num_words):
+        t = time.monotonic() - self.start_time
+        end = addr + num_words * 2 // self.bytes_per_address
+
+        for field_addr, field_type, scale, waveform in self.fields:
+            if addr <= field_addr < end and field_addr not in self.written:
+                low, high = REGISTER_LIMITS[field_type]
+                raw = min(high, max(low, int(round(waveform(t, self) / (scale or 1)))))
+                struct.pack_into(">" + REGISTER_TYPES[field_type][0], self.image, field_addr * self.bytes_per_address, raw)
+
+    def handle_pdu(self, pdu):
+        function_code = pdu[0]
+
+        with self.lock:
+            if function_code == READ_HOLDING_REGISTERS:
+                addr, num_words = struct.unpack(">HH", pdu[1:5])
+                if not 1 <= num_words <= 125:
+                    return bytes([function_code | 0x80, 0x03])
+                self._refresh_fields(addr, num_words)
+                offset = addr * self.bytes_per_address
+                return bytes([function_code, 2 * num_words]) + bytes(self.image[offset : offset + 2 * num_words])
+
+            if function_code in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+                addr, value = struct.unpack(">HH", pdu[1:5])
+                self.set_words(addr, [value])
+                self.stats["writes"] += 1
+                return pdu[:5]
+
+            if function_code == WRITE_MULTIPLE_REGISTERS:
+                addr, num_words, byte_count = struct.unpack(">HHB", pdu[1:6])
+                self.set_words(addr, list(struct.unpack(">{}H".format(num_words), pdu[6 : 6 + byte_count])))
+                self.stats["writes"] += 1
+                return pdu[:5]
+
+        return bytes([function_code | 0x80, 0x01])
+
+    def _make_handler(self):
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def _recv_exactly(self, num_bytes):
+                data = b""
+                while len(data) < num_bytes:
+                    chunk = self.request.recv(num_bytes - len(data))
+                    if not chunk:
+                        raise ConnectionError("Client closed connection")
+                    data += chunk
+                return data
+
+            def handle(self):
+                try:
+                    while True:
+                        header = self._recv_exactly(7)
+                        transaction_id, protocol_id, length, unit_id = struct.unpack(">HHHB", header)
+                        pdu = self._recv_exactly(length - 1)
+                        sim.stats["requests"] += 1
+
+                        if sim.rng.random() < sim.loss_rate:
+                            sim.stats["lost"] += 1
+                            continue
+
+                        if sim.rng.random() < sim.timeout_rate:
+                            sim.stats["timeouts"] += 1
+                            time.sleep(sim.timeout_delay)
+                        else:
+                            time.sleep(max(0.0, sim.latency + sim.rng.uniform(-sim.jitter, sim.jitter)))
+
+                        rx_pdu = sim.handle_pdu(pdu)
+                        self.request.sendall(struct.pack(">HHHB", transaction_id, 0, len(rx_pdu) + 1, unit_id) + rx_pdu)
+
+                        if not sim.pipelining:
+                            # a gateway without pipelining forgets requests that arrived while it was busy
+                            while select.select([self.request], [], [], 0)[0]:
+                                if not self.request.recv(4096):
+                                    return
+                                sim.stats["discarded"] += 1
+                except (ConnectionError, OSError):
+                    return
+
+        return Handler
+
+    def start(self):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), self._make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(10)
+                print("{}:{} {}".format(self.host, self.port, self.stats))
+        except KeyboardInterrupt:
+            self.stop()
+
+def sofar_fields(waveforms = None):
+    import sofar
+
+    default_waveforms = {
+        "sys_state": Constant(2),
+        "inverter_power_kW": Sine(3.0, 2.5, 900.0),
+        "grid_power_kW": RandomWalk(0.5, 0.2, -8.0, 8.0),
+        "pv_power_kW": Sine(4.0, 4.0, 3600.0, floor = 0.0),
+        "battery_power_charge_kW": Sine(0.0, 2.5, 1200.0),
+        "soc": Constant(60),
+        "soh": Constant(100),
+        "cycle_cnt": Constant(120)
+    }
+    default_waveforms.update(waveforms or {})
+
+    registers = sofar.POWER_REGISTERS + sofar.BATTERY_REGISTERS + sofar.TEMPERATURE_REGISTERS + sofar.INVERTER_REGISTERS
+    return [(addr, register_type, scale, default_waveforms.get(key, Constant(25)))
+            for addr, register_type, scale, key in registers]
+
+def hoymiles_fields(waveforms = None, num_channels = 8):
+    import hoymiles
+
+    # waveforms are keyed by (channel, field key)
+    default_waveforms = {}
+    for channel in range(num_channels):
+        default_waveforms[(channel, "port_number")] = Constant(channel % 4)
+        default_waveforms[(channel, "pv_voltage_V")] = Sine(38.0, 4.0, 3600.0, phase = 0.3 * channel)
+        default_waveforms[(channel, "pv_current_A")] = Sine(5.0, 5.0, 3600.0, phase = 0.3 * channel, floor = 0.0)
+        default_waveforms[(channel, "grid_voltage_V")] = Sine(230.0, 3.0, 300.0)
+        default_waveforms[(channel, "grid_frequency_Hz")] = Sine(50.0, 0.02, 60.0)
+        default_waveforms[(channel, "pv_power_kW")] = Limited(Sine(0.2, 0.2, 3600.0, phase = 0.3 * channel, floor = 0.0), 0xC001)
+        default_waveforms[(channel, "energy_today_kWh")] = Constant(1.2)
+        default_waveforms[(channel, "energy_total_kWh")] = Constant(1234.5)
+        default_waveforms[(channel, "temperature_deg")] = Sine(35.0, 10.0, 3600.0)
+        default_waveforms[(channel, "operating_status")] = Constant(3)
+        default_waveforms[(channel, "link_status")] = Constant(1)
+    default_waveforms.update(waveforms or {})
+
+    registers = hoymiles.channel_registers(range(num_channels))
+    return [(addr, register_type, scale, default_waveforms.get((channel, key), Constant(0)))
+            for channel in range(num_channels)
+            for addr, register_type, scale, key in registers[f"channel_{channel}"]]
+
+def sofar_simulator(waveforms = None, **kwargs):
+    return DeviceSimulator(sofar_fields(waveforms), bytes_per_address = 2, **kwargs)
+
+def hoymiles_simulator(waveforms = None, num_channels = 8, **kwargs):
+    return DeviceSimulator(hoymiles_fields(waveforms, num_channels), bytes_per_address = 1, **kwargs)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Modbus-TCP simulator for the Sofar inverter and the Hoymiles DTU")
+    parser.add_argument("device", choices = ["sofar", "hoymiles"])
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 5020)
+    parser.add_argument("--latency", type = float, default = 0.02, help = "mean response latency in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.005, help = "uniform latency jitter in seconds")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "fraction of requests that are never answered")
+    parser.add_argument("--timeout-rate", type = float, default = 0.0, help = "fraction of requests answered only after --timeout-delay")
+    parser.add_argument("--timeout-delay", type = float, default = 5.0)
+    parser.add_argument("--no-pipelining", action = "store_true", help = "discard requests arriving while busy")
+    parser.add_argument("--seed", type = int, default = None)
+    args = parser.parse_args()
+
+    make_simulator = sofar_simulator if args.device == "sofar" else hoymiles_simulator
+    sim = make_simulator(host = args.host, port = args.port, latency = args.latency, jitter = args.jitter,
+                         loss_rate = args.loss, timeout_rate = args.timeout_rate, timeout_delay = args.timeout_delay,
+                         pipelining = not args.no_pipelining, seed = args.seed)
+
+    print(f"Serving simulated {args.device} on {args.host}:{args.port}")
+    sim.serve_forever()
@@ -0,0 +1,139 @@
+import asyncio, struct, operator
+from pyModbusTCP.client import ModbusClient
+from tracing import TX, RX
+
+MODBUS_MAX_READ_WORDS = 125
+
+# register types: struct format code and size in bytes (multi-word values are big-endian, high word first)
+REGISTER_TYPES = {
+    "U8": ("B", 1),
+    "U16": ("H", 2),
+    "L16": ("h", 2),
+    "U32": ("I", 4),
+    "L32": ("i", 4)
+}
+
+class ReadPlanner:
+
+    def __init__(self, max_gap = 8, max_block = MODBUS_MAX_READ_WORDS, bytes_per_address = 2):
+        if not 1 <= max_block <= MODBUS_MAX_READ_WORDS:
+            raise ValueError(f"max_block out of range (valid from 1 to {MODBUS_MAX_READ_WORDS})")
+
+        # limits are given in words; devices with byte-addressed registers use bytes_per_address = 1
+        self.max_gap = max_gap
+        self.max_block = max_block
+        self.bytes_per_address = bytes_per_address
+
+    def num_words(self, num_addresses):
+        return -(-num_addresses * self.bytes_per_address // 2)
+
+    def plan(self, spans):
+
+        # spans are (addr, num_addresses) tuples; returns a list of (block_addr, block_num_words)
+        # covering all of them with as few reads as the gap and block size limits allow
+        max_gap = self.max_gap * 2 // self.bytes_per_address
+        max_block = self.max_block * 2 // self.bytes_per_address
+
+        blocks = []
+        for addr, num_addresses in sorted(set(spans)):
+            end = addr + num_addresses
+
+            if blocks:
+                block_addr, block_end = blocks[-1]
+                gap = addr - block_end
+                if gap <= max_gap and max(end, block_end) - block_addr <= max_block:
+                    blocks[-1] = (block_addr, max(end, block_end))
+                    continue
+
+            if num_addresses > max_block:
+                raise ValueError(f"Span at {hex(addr)} exceeds maximum block size")
+            blocks.append((addr, end))
+
+        return [(block_addr, self.num_words(block_end - block_addr)) for block_addr, block_end in blocks]
+
+class RegisterBlock:
+
+    def __init__(self, addr, num_words, fields, bytes_per_address):
+        self.addr = addr
+        self.num_words = num_words
+
+        # one struct covering the whole block, gaps between fields are skipped as pad bytes
+        fmt = ">"
+        cursor = 0
+        for field_addr, field_type, scale, target, key in fields:
+            code, size = REGISTER_TYPES[field_type]
+            offset = (field_addr - addr) * bytes_per_address
+            if offset < cursor:
+                raise ValueError(f"Register at {hex(field_addr)} overlaps its predecessor")
+            fmt += "{}x{}".format(offset - cursor, code) if offset > cursor else code
+            cursor = offset + size
+
+        if cursor < 2 * num_words:
+            fmt += "{}x".format(2 * num_words - cursor)
+
+        self.words_struct = struct.Struct(">{}H".format(num_words))
+        self.fields_struct = struct.Struct(fmt)
+
+        # per target: getter for its values, the keys they go to and their scale factors
+        self.targets = []
+        for target in dict.fromkeys(field[3] for field in fields):
+            indices = [ind for ind, field in enumerate(fields) if field[3] == target]
+            self.targets.append((target,
+                                 self._make_getter(indices),
+                                 tuple(fields[ind][4] for ind in indices),
+                                 tuple(fields[ind][2] for ind in indices)))
+
+    def _make_getter(self, indices):
+        if len(indices) == 1:
+            ind = indices[0]
+            return lambda values: (values[ind],)
+        return operator.itemgetter(*indices)
+
+    def decode(self, words, targets):
+        values = self.fields_struct.unpack(self.words_struct.pack(*words))
+        for target, getter, keys, scales in self.targets:
+            targets[target].update(zip(keys, map(operator.mul, getter(values), scales)))
+
+class RegisterMap:
+
+    def __init__(self, registers, planner):
+
+        # registers maps a target name to a list of (addr, type, scale, key) tuples,
+        # scale None keeps the raw integer
+        fields = sorted((addr, field_type, 1 if scale is None else scale, target, key)
+                        for target, target_registers in registers.items()
+                        for addr, field_type, scale, key in target_registers)
+
+        for field in fields:
+            if field[1] not in REGISTER_TYPES:
+                raise ValueError(f"Unknown register type '{field[1]}'")
+
+        def _num_addresses(field):
+            return -(-REGISTER_TYPES[field[1]][1] // planner.bytes_per_address)
+
+        self.blocks = []
+        for block_addr, block_num_words in planner.plan((field[0], _num_addresses(field)) for field in fields):
+            block_end = block_addr + block_num_words * 2 // planner.bytes_per_address
+            block_fields = [field for field in fields if block_addr <= field[0] < block_end]
+            self.blocks.append(RegisterBlock(block_addr, block_num_words, block_fields, planner.bytes_per_address))
+
+    def read(self, read_fn, targets):
+        for block in self.blocks:
+            block.decode(read_fn(block.addr, block.num_words), targets)
+
+    async def read_async(self, read_fn, targets):
+        # all blocks are requested at once, the client decides how many go out in parallel
+        blocks_words = await asyncio.gather(*[read_fn(block.addr, block.num_words) for block in self.blocks])
+        for block, words in zip(self.blocks, blocks_words):
+            block.decode(words, targets)
+
+class TracedModbusClient(ModbusClient):
+
+    # pyModbusTCP hands every raw frame to _debug_dump, which only prints in debug mode
+    def __init__(self, tracer, **kwargs):
+        self.tracer = tracer
+        super().__init__(**kwargs)
+
+    def _debug_dump(self, label, frame):
+        self.tracer.record(TX if label == "Tx" else RX, frame)
+        super()._debug_dump(label, frame)
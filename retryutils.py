@@ -0,0 +1,161 @@
+import asyncio, random, threading, time
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+class RetryPolicy:
+
+    def __init__(self, deadline = 1.0, base_delay = 0.05, max_delay = 0.4, jitter = 0.5):
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+        self.retry_count = 0
+        self.failure_count = 0
+
+    def _backoff(self, attempt):
+        # capped exponential backoff, randomly shortened by up to the jitter fraction
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1.0 - self.jitter * random.random())
+
+    def call(self, fn, *args):
+        end_time = time.monotonic() + self.deadline
+
+        attempt = 0
+        while True:
+            try:
+                return fn(*args)
+            except (ConnectionError, TimeoutError, OSError, RuntimeError) as e:
+                last_error = e
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            if time.monotonic() + delay >= end_time:
+                self.failure_count += 1
+                raise TimeoutError(f"Error: giving up after {attempt} attempts") from last_error
+
+            self.retry_count += 1
+            time.sleep(delay)
+
+    async def call_async(self, fn, *args):
+        end_time = time.monotonic() + self.deadline
+
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args)
+            except (ConnectionError, TimeoutError, OSError, RuntimeError) as e:
+                last_error = e
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            if time.monotonic() + delay >= end_time:
+                self.failure_count += 1
+                raise TimeoutError(f"Error: giving up after {attempt} attempts") from last_error
+
+            self.retry_count += 1
+            await asyncio.sleep(delay)
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold = 3, probe_interval = 5.0, probe = None, verbose = True, name = "device", on_trip = None):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.verbose = verbose
+        self.name = name
+
+        # without a probe function the breaker lets a single trial call through after probe_interval
+        self.probe = probe
+        self.on_trip = on_trip
+
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.shed_count = 0
+        self.trip_count = 0
+        self.opened_at = 0.0
+
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+
+            if self.state == "open" and self.probe is None and time.monotonic() - self.opened_at >= self.probe_interval:
+                self.state = "half_open"
+                return True
+
+            self.shed_count += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed" and self.verbose:
+                print(f"{self.name}: communication restored, closing circuit breaker.")
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            tripped = self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold)
+            if tripped:
+                self._trip()
+
+        if tripped and self.on_trip is not None:
+            self.on_trip()
+
+    def _trip(self):
+        if self.verbose:
+            print(f"{self.name}: {self.consecutive_failures} consecutive failures, opening circuit breaker.")
+
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trip_count += 1
+
+        if self.probe is not None:
+            threading.Thread(target = self._probe_loop, daemon = True).start()
+
+    def _probe_loop(self):
+        while self.state == "open":
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                continue
+            self.record_success()
+
+    def call(self, fn, *args):
+        if not self.allow_request():
+            raise CircuitOpenError(f"Error: circuit breaker for {self.name} is open")
+
+        try:
+            result = fn(*args)
+        except Exception:
+            self.record_failure()
+            raise
+
+        self.record_success()
+        return result
+
+    async def call_async(self, fn, *args):
+        if not self.allow_request():
+            raise CircuitOpenError(f"Error: circuit breaker for {self.name} is open")
+
+        try:
+            result = await fn(*args)
+        except Exception:
+            self.record_failure()
+            raise
+
+        self.record_success()
+        return result
+
+    def get_status(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "shed_count": self.shed_count,
+            "trip_count": self.trip_count
+        }
@@ -1,11 +1,85 @@
-from pyModbusTCP.client import ModbusClient
+from modbusutils import ReadPlanner, RegisterMap, TracedModbusClient
+from asyncmodbus import AsyncModbusClient
+from retryutils import RetryPolicy, CircuitBreaker
+from tracing import get_tracer
 import time, timeutils
 
+POWER_REGISTERS = [
+    (0x0485, "L16", 0.01, "inverter_power_kW"),
+    (0x0488, "L16", 0.01, "grid_power_kW"),
+    (0x05C4, "U16", 0.1, "pv_power_kW"),
+    (0x0606, "L16", 0.01, "battery_power_charge_kW")
+]
+
+BATTERY_REGISTERS = [
+    (0x0607, "L16", None, "temp_ambient_deg"),
+    (0x0608, "U16", None, "soc"),
+    (0x0609, "U16", None, "soh"),
+    (0x060A, "U16", None, "cycle_cnt"),
+    (0x906B, "L16", 0.1, "temp_BMS_pack_0_deg"),
+    (0x906C, "L16", 0.1, "temp_BMS_pack_1_deg"),
+    (0x906D, "L16", 0.1, "temp_BMS_pack_2_deg"),
+    (0x906E, "L16", 0.1, "temp_BMS_pack_3_deg")
+]
+
+TEMPERATURE_REGISTERS = [
+    (0x0418, "L16", None, "temp_env_deg_1"),
+    (0x0419, "L16", None, "temp_env_deg_2"),
+    (0x041A, "L16", None, "temp_heat_sink_deg_1"),
+    (0x041B, "L16", None, "temp_heat_sink_deg_2"),
+    (0x041C, "L16", None, "temp_heat_sink_deg_3"),
+    (0x041D, "L16", None, "temp_heat_sink_deg_4"),
+    (0x041E, "L16", None, "temp_heat_sink_deg_5"),
+    (0x041F, "L16", None, "temp_heat_sink_deg_6"),
+    (0x0420, "L16", None, "temp_inv_deg_1"),
+    (0x0421, "L16", None, "temp_inv_deg_2"),
+    (0x0422, "L16", None, "temp_inv_deg_3")
+]
+
+INVERTER_REGISTERS = [
+    (0x0404, "U16", None, "sys_state")
+]
+
 class SofarInverter:
 
-    def __init__(self, host, port):
-        self.c = ModbusClient(host = host, port = port, unit_id = 1,
-                              auto_open = True, debug = False, timeout = 0.1)
+    def __init__(self, host, port, max_read_gap = 24, max_read_block = 64, async_max_in_flight = 4, async_timeout = 1.0,
+                 io_deadline = 1.0, breaker_threshold = 3, breaker_probe_interval = 5.0,
+                 control_cache_max_age = 60.0, remote_refresh_margin = 3.0):
+        # all frames go into an always-on ring buffer, which is dumped when the breaker trips
+        self.tracer = get_tracer(f"sofar_{host}_{port}")
+        self.c = TracedModbusClient(self.tracer, host = host, port = port, unit_id = 1,
+                                    auto_open = True, debug = False, timeout = 0.1)
+
+        # every register access is bounded by the retry deadline; while the inverter is silent
+        # the breaker sheds requests and a background probe watches for it to come back
+        self.retry_policy = RetryPolicy(deadline = io_deadline)
+        self.breaker = CircuitBreaker(failure_threshold = breaker_threshold, probe_interval = breaker_probe_interval,
+                                      probe = self._probe, name = "Sofar", on_trip = self.dump_trace)
+
+        # asyncio client mode, created on first use from within the running event loop
+        self.host = host
+        self.port = port
+        self.async_max_in_flight = async_max_in_flight
+        self.async_timeout = async_timeout
+        self.ac = None
+
+        # last confirmed values of the control registers: addr -> (words, monotonic time of confirmation);
+        # writes of already confirmed values are skipped, entries expire so that the device state is re-asserted
+        self.control_cache = {}
+        self.control_cache_max_age = control_cache_max_age
+        self.remote_refresh_margin = remote_refresh_margin
+        self.remote_expires_at = 0.0
+
+        # neighbouring registers are fetched in one transaction, gaps are read and discarded
+        self.read_planner = ReadPlanner(max_gap = max_read_gap, max_block = max_read_block)
+
+        self.power_map = RegisterMap({"power_status": POWER_REGISTERS}, self.read_planner)
+        self.battery_map = RegisterMap({"battery_status": BATTERY_REGISTERS}, self.read_planner)
+        self.temperature_map = RegisterMap({"temperature_status": TEMPERATURE_REGISTERS}, self.read_planner)
+        self.inverter_map = RegisterMap({"inverter_status": INVERTER_REGISTERS}, self.read_planner)
+        self.aux_map = RegisterMap({"battery_status": BATTERY_REGISTERS,
+                                    "temperature_status": TEMPERATURE_REGISTERS,
+                                    "inverter_status": INVERTER_REGISTERS}, self.read_planner)
 
         self.sys_state_map = {
             0: "Waiting",
@@ -62,68 +136,143 @@ class SofarInverter:
         }
 
     def update_temperature_status(self):
-        words = self.read_register(0x0418, 11)
-        self.temperature_status["temp_env_deg_1"] = self.word_to_L16(words[0])
-        self.temperature_status["temp_env_deg_2"] = self.word_to_L16(words[1])
-        self.temperature_status["temp_heat_sink_deg_1"] = self.word_to_L16(words[2])
-        self.temperature_status["temp_heat_sink_deg_2"] = self.word_to_L16(words[3])
-        self.temperature_status["temp_heat_sink_deg_3"] = self.word_to_L16(words[4])
-        self.temperature_status["temp_heat_sink_deg_4"] = self.word_to_L16(words[5])
-        self.temperature_status["temp_heat_sink_deg_5"] = self.word_to_L16(words[6])
-        self.temperature_status["temp_heat_sink_deg_6"] = self.word_to_L16(words[7])
-        self.temperature_status["temp_inv_deg_1"] = self.word_to_L16(words[8])
-        self.temperature_status["temp_inv_deg_2"] = self.word_to_L16(words[9])
-        self.temperature_status["temp_inv_deg_3"] = self.word_to_L16(words[10])
-        self.temperature_status["last_updated"] = timeutils.get_current_timestamp()
-        
+        self.read_register_map(self.temperature_map)
+        self._finalize_temperature_status()
+
     def update_battery_status(self):
         start_time = timeutils.get_current_time()
-        words = self.read_register(0x0607, 4)
-        self.battery_status["temp_ambient_deg"] = self.word_to_L16(words[0])
-        self.battery_status["soc"] = self.word_to_U16(words[1])
-        self.battery_status["soh"] = self.word_to_U16(words[2])
-        self.battery_status["cycle_cnt"] = self.word_to_U16(words[3])
-
-        words = self.read_register(0x906B, 4)
-        self.battery_status["temp_BMS_pack_0_deg"] = self.word_to_L16(words[0]) * 0.1
-        self.battery_status["temp_BMS_pack_1_deg"] = self.word_to_L16(words[1]) * 0.1
-        self.battery_status["temp_BMS_pack_2_deg"] = self.word_to_L16(words[2]) * 0.1
-        self.battery_status["temp_BMS_pack_3_deg"] = self.word_to_L16(words[3]) * 0.1
+        self.read_register_map(self.battery_map)
         end_time = timeutils.get_current_time()
-        
-        self.battery_status["last_updated"] = timeutils.get_timestamp(end_time)
+
+        self._finalize_battery_status()
         self.battery_status["latency_ms"] = timeutils.measure_time_ms(start_time, end_time)
 
     def update_inverter_status(self):
-        sys_state = self.read_U16(0x0404)
-        self.inverter_status["sys_state"] = sys_state
-        self.inverter_status["sys_state_string"] = self.sys_state_map[sys_state]
-        self.inverter_status["last_updated"] = timeutils.get_current_timestamp()
-        
-    def update_power_status(self, inter_read_sleep = 0.01):
+        self.read_register_map(self.inverter_map)
+        self._finalize_inverter_status()
+
+    def update_aux_status(self):
+        # battery, inverter and temperature registers planned together as one poll
         start_time = timeutils.get_current_time()
-        self.power_status["battery_power_charge_kW"] = self.read_L16(0x0606) * 0.01
-        self.power_status["inverter_power_kW"] = self.read_L16(0x0485) * 0.01
-        time.sleep(inter_read_sleep)
-        self.power_status["pv_power_kW"] = self.read_U16(0x05C4) * 0.1
-        time.sleep(inter_read_sleep)
-        self.power_status["grid_power_kW"] = self.read_L16(0x0488) * 0.01
+        self.read_register_map(self.aux_map)
+        end_time = timeutils.get_current_time()
+
+        self._finalize_inverter_status()
+        self._finalize_temperature_status()
+        self._finalize_battery_status()
+        self.battery_status["latency_ms"] = timeutils.measure_time_ms(start_time, end_time)
+
+    def update_power_status(self):
+        start_time = timeutils.get_current_time()
+        self.read_register_map(self.power_map)
         end_time = timeutils.get_current_time()
         self.power_status["last_updated"] = timeutils.get_timestamp(end_time)
         self.power_status["latency_ms"] = timeutils.measure_time_ms(start_time, end_time)
 
+    async def update_aux_status_async(self):
+        start_time = timeutils.get_current_time()
+        await self.read_register_map_async(self.aux_map)
+        end_time = timeutils.get_current_time()
+
+        self._finalize_inverter_status()
+        self._finalize_temperature_status()
+        self._finalize_battery_status()
+        self.battery_status["latency_ms"] = timeutils.measure_time_ms(start_time, end_time)
+
+    async def update_power_status_async(self):
+        start_time = timeutils.get_current_time()
+        await self.read_register_map_async(self.power_map)
+        end_time = timeutils.get_current_time()
+        self.power_status["last_updated"] = timeutils.get_timestamp(end_time)
+        self.power_status["latency_ms"] = timeutils.measure_time_ms(start_time, end_time)
+
+    def _finalize_temperature_status(self):
+        self.temperature_status["last_updated"] = timeutils.get_current_timestamp()
+
+    def _finalize_battery_status(self):
+        self.battery_status["last_updated"] = timeutils.get_current_timestamp()
+
+    def _finalize_inverter_status(self):
+        self.inverter_status["sys_state_string"] = self.sys_state_map.get(self.inverter_status["sys_state"], "N/A")
+        self.inverter_status["last_updated"] = timeutils.get_current_timestamp()
+
     def set_remote(self, timeout = 10):
-        self.write_and_verify_register(0x1184, [self.U16_to_word(timeout), 1])
-        self.write_and_verify_register(0x1110, [3])
+        if self._remote_refresh_due(timeout):
+            self._write_control_register(0x1184, [self.U16_to_word(timeout), 1], verify = True, force = True)
+            self.remote_expires_at = time.monotonic() + timeout
+        self._write_control_register(0x1110, [3], verify = True)
 
     def set_local(self):
-        self.write_and_verify_register(0x1110, [0])
+        self._write_control_register(0x1110, [0], verify = True)
 
     def set_battery_power_charge_kW(self, power):
+        self._write_control_register(0x1187, self._charge_power_words(power), verify = False)
+
+    def set_remote_battery_power_charge_kW(self, power, timeout = 10):
+
+        # the remote timeout (0x1184 - 0x1185) and the charge setpoint (0x1187 - 0x118C) are refreshed
+        # in one write when both are due; 0x1186 lies in between and is written back unchanged.
+        # Only the timeout words are read back, the setpoint is not verified (as in set_battery_power_charge_kW).
+        # The mode register 0x1110 is too far away to join them.
+        timeout_words = [self.U16_to_word(timeout), 1]
+        setpoint_words = self._charge_power_words(power)
+
+        refresh_due = self._remote_refresh_due(timeout)
+        setpoint_due = not self._is_confirmed(0x1187, setpoint_words)
+
+        if refresh_due and setpoint_due:
+            gap_words = self._read_control_register(0x1186, 1)
+            self.control_cache.pop(0x1184, None)
+            self.control_cache.pop(0x1187, None)
+            self.write_and_verify_register(0x1184, timeout_words + gap_words + setpoint_words, num_verify_words = len(timeout_words))
+            self._confirm(0x1184, timeout_words)
+            self._confirm(0x1187, setpoint_words)
+            self.remote_expires_at = time.monotonic() + timeout
+        elif refresh_due:
+            self.set_remote(timeout)
+        elif setpoint_due:
+            self.set_battery_power_charge_kW(power)
+
+        self._write_control_register(0x1110, [3], verify = True)
+
+    def invalidate_control_cache(self):
+        self.control_cache.clear()
+        self.remote_expires_at = 0.0
+
+    def _charge_power_words(self, power):
         power_W = int(1000 * power)
-        data = [0, 0] + self.L32_to_words(power_W) + self.L32_to_words(power_W)
-        self.write_register(0x1187, data)
-        
+        return [0, 0] + self.L32_to_words(power_W) + self.L32_to_words(power_W)
+
+    def _remote_refresh_due(self, timeout):
+        return not self._is_confirmed(0x1184, [self.U16_to_word(timeout), 1]) or \
+            time.monotonic() >= self.remote_expires_at - self.remote_refresh_margin
+
+    def _is_confirmed(self, addr, words):
+        cached = self.control_cache.get(addr)
+        return cached is not None and cached[0] == words and time.monotonic() - cached[1] < self.control_cache_max_age
+
+    def _confirm(self, addr, words):
+        self.control_cache[addr] = (list(words), time.monotonic())
+
+    def _read_control_register(self, addr, num_words):
+        # cached values expire like confirmed writes, so that changes made elsewhere are picked up
+        cached = self.control_cache.get(addr)
+        if cached is None or time.monotonic() - cached[1] >= self.control_cache_max_age:
+            self._confirm(addr, self.read_register(addr, num_words))
+        return list(self.control_cache[addr][0])
+
+    def _write_control_register(self, addr, words, verify, force = False):
+        if not force and self._is_confirmed(addr, words):
+            return
+
+        # an unconfirmed write leaves the register in an unknown state
+        self.control_cache.pop(addr, None)
+        if verify:
+            self.write_and_verify_register(addr, words)
+        else:
+            self.write_register(addr, words)
+        self._confirm(addr, words)
+
     def read_U16(self, addr):
         return self.word_to_U16(self.read_register(addr, 1)[0])
 
@@ -168,32 +317,79 @@ class SofarInverter:
             val_bytes += word.to_bytes(2, byteorder = "big", signed = False)
         return int.from_bytes(val_bytes, byteorder = "big", signed = False)    
         
-    def read_register(self, addr, num_words, verbose = False, timeout = 0.2):
-        while True:
-            try:
-                words = self.c.read_holding_registers(addr, num_words)
-                if words is None:
-                    raise RuntimeError("Error: no data received")
-                return words
-            except:
-                if verbose:
-                    print("{}: Sofar modbus communication error.".format(timeutils.get_current_timestamp()))
-                time.sleep(timeout)
-
-    def write_and_verify_register(self, addr, words_to_write, inter_read_sleep = 0.01, timeout = 0.2, verbose = True):
-        while True:
-            self.write_register(addr, words_to_write)
+    def read_register_map(self, register_map):
+        register_map.read(self.read_register, {"power_status": self.power_status,
+                                               "battery_status": self.battery_status,
+                                               "temperature_status": self.temperature_status,
+                                               "inverter_status": self.inverter_status})
+
+    async def read_register_map_async(self, register_map):
+        await register_map.read_async(self.read_register_async, {"power_status": self.power_status,
+                                                                  "battery_status": self.battery_status,
+                                                                  "temperature_status": self.temperature_status,
+                                                                  "inverter_status": self.inverter_status})
+
+    async def read_register_async(self, addr, num_words):
+        if self.ac is None:
+            self.ac = AsyncModbusClient(host = self.host, port = self.port, unit_id = 1,
+                                        timeout = self.async_timeout, max_in_flight = self.async_max_in_flight,
+                                        tracer = self.tracer)
+        return await self.breaker.call_async(self.retry_policy.call_async, self.ac.read_holding_registers, addr, num_words)
+
+    def read_register(self, addr, num_words, verbose = False):
+        try:
+            return self.breaker.call(self.retry_policy.call, self._read_register_once, addr, num_words)
+        except (TimeoutError, ConnectionError):
+            if verbose:
+                print("{}: Sofar modbus communication error.".format(timeutils.get_current_timestamp()))
+            raise
+
+    def write_and_verify_register(self, addr, words_to_write, inter_read_sleep = 0.01, num_verify_words = None):
+
+        # only the first num_verify_words words are read back, if given
+        words_to_verify = list(words_to_write[:num_verify_words]) if num_verify_words is not None else list(words_to_write)
+
+        def _write_and_verify():
+            self._write_register_once(addr, words_to_write)
             time.sleep(inter_read_sleep)
-            readback = self.read_register(addr, len(words_to_write))
-            if words_to_write == readback:
-                break
-            else:
+            readback = self._read_register_once(addr, len(words_to_verify))
+            if words_to_verify != readback:
                 print("{}: Sofar write error.".format(timeutils.get_current_timestamp()))
-                time.sleep(timeout)
-                
-    def write_register(self, addr, words_to_write):        
-        return self.c.write_multiple_registers(addr, words_to_write)
-    
+                raise RuntimeError("Error: readback does not match written data")
+
+        self.breaker.call(self.retry_policy.call, _write_and_verify)
+
+    def write_register(self, addr, words_to_write):
+        return self.breaker.call(self.retry_policy.call, self._write_register_once, addr, words_to_write)
+
+    def _read_register_once(self, addr, num_words):
+        words = self.c.read_holding_registers(addr, num_words)
+        if words is None:
+            self.tracer.record_error(f"read 0x{addr:04X} ({num_words} words): {self.c.last_error_as_txt}")
+            raise ConnectionError("Error: no data received")
+        return words
+
+    def _write_register_once(self, addr, words_to_write):
+        if not self.c.write_multiple_registers(addr, words_to_write):
+            self.tracer.record_error(f"write 0x{addr:04X} ({len(words_to_write)} words): {self.c.last_error_as_txt}")
+            raise ConnectionError("Error: write not acknowledged")
+        return True
+
+    def _probe(self):
+        self._read_register_once(0x0404, 1)
+
+        # the inverter may have restarted while it was silent
+        self.invalidate_control_cache()
+
+    def dump_trace(self, last = 50):
+        print(self.tracer.format(last))
+
+    def get_io_status(self):
+        io_status = self.breaker.get_status()
+        io_status["retry_count"] = self.retry_policy.retry_count
+        io_status["failure_count"] = self.retry_policy.failure_count
+        return io_status
+
 if __name__ == "__main__":
 
     sofar_inverter = SofarInverter(host = '192.168.1.146', port = 26)
@@ -1,6 +1,11 @@
 import appdaemon.plugins.hass.hassapi as hass
 from sofar import SofarInverter
-import datetime, math
+from cadence import AdaptiveCadence
+from timeseries import TimeSeriesStore
+import datetime, math, os, threading, time, timeutils, tracing
+
+# channels of the power samples kept in power_history
+POWER_HISTORY_CHANNELS = ["grid_power_kW", "pv_power_kW", "load_power_kW", "battery_power_charge_kW"]
 
 class SolarMgr(hass.Hass):
 
@@ -10,8 +15,12 @@ class SolarMgr(hass.Hass):
         self.listen_state(self.scheduler_remote_on, "input_boolean.scheduler_remote", new = "on")
         self.listen_state(self.scheduler_remote_off, "input_boolean.scheduler_remote", new = "off")
         
-        self.sofar_inverter = SofarInverter(host = '192.168.1.146', port = 26)
-        self.sofar_inverter.set_local()
+        self.sofar_inverter = SofarInverter(host = '192.168.1.146', port = 26,
+                                            async_max_in_flight = self.args.get("sofar_max_in_flight", 4))
+        try:
+            self.sofar_inverter.set_local()
+        except (TimeoutError, ConnectionError):
+            print("{}: Sofar not reachable at startup, scheduler will retry.".format(timeutils.get_current_timestamp()))
 
         self.scheduler_status = {
             "state": "inactive",
@@ -20,8 +29,16 @@ class SolarMgr(hass.Hass):
 
         self.scheduler_params = {
             "battery_charge_power_max_kW": 2.0,
-            "battery_scheduler_soc_max": 99
+            "battery_scheduler_soc_max": 99,
+            "remote_timeout": 10
         }
+
+        # the scheduler runs after every power poll and on its own timer, which has to refresh the remote
+        # timeout before it lapses however long the adaptive poll interval gets; the lock keeps a poll-triggered
+        # run (in an executor thread with sofar_async) and a timer run from overlapping
+        self.scheduler_interval = min(self.args.get("scheduler_interval", 4),
+                                      self.scheduler_params["remote_timeout"] - self.sofar_inverter.remote_refresh_margin)
+        self.scheduler_lock = threading.Lock()
         
         self.global_status = {
             "grid_power_kW": 0.0,
@@ -30,67 +47,222 @@ class SolarMgr(hass.Hass):
             "last_updated": "Never"
         }
         
-        self.run_every(self.update_power_status, "now", 4)
-        self.run_every(self.update_aux_status, "now", 15)
+        # poll intervals follow the rate of change of grid, PV and battery power within the configured bounds
+        self.power_cadence = AdaptiveCadence(min_interval = self.args.get("power_poll_interval_min", 2),
+                                             max_interval = self.args.get("power_poll_interval_max", 20),
+                                             low_rate = self.args.get("cadence_low_rate_kW_per_s", 0.002),
+                                             high_rate = self.args.get("cadence_high_rate_kW_per_s", 0.1))
+
+        self.aux_cadence = AdaptiveCadence(min_interval = self.args.get("aux_poll_interval_min", 15),
+                                           max_interval = self.args.get("aux_poll_interval_max", 120),
+                                           low_rate = self.args.get("cadence_low_rate_kW_per_s", 0.002),
+                                           high_rate = self.args.get("cadence_high_rate_kW_per_s", 0.1))
+
+        # close to the export cap the grid power is polled at the shortest interval, so that
+        # the export limiter in hoymiles_mgr reacts within seconds
+        self.fast_poll_above_grid_power_kW = self.args.get("fast_poll_above_grid_power_kW")
+
+        # every power poll, for power_history_days at the shortest poll interval (about 1 MB per day at 2 s);
+        # kept in a memory-mapped file that survives restarts unless power_history_path is null
+        history_capacity = int(self.args.get("power_history_days", 3) * 86400 / self.power_cadence.min_interval)
+        self.power_history = TimeSeriesStore(POWER_HISTORY_CHANNELS, history_capacity,
+                                             path = self.args.get("power_history_path", os.path.join(os.path.dirname(os.path.abspath(__file__)), "power_history.bin")))
+        self.run_every(self.flush_power_history, "now", 60)
+
+        # rolling 24 h figures from the history; intervals longer than power_history_max_gap seconds
+        # (failed polls, restarts) are left out of the energy integrals, as in statistic_mgr
+        self.power_history_max_gap = self.args.get("power_history_max_gap", 60)
+        self.run_every(self.publish_power_history, "now", self.args.get("power_history_publish_interval", 300))
+
+        # every poll schedules its successor
+        if self.args.get("sofar_async", False):
+            # polls run on the event loop and share one pipelined connection
+            self.run_in(self.update_power_status_async, 0)
+            self.run_in(self.update_aux_status_async, 0)
+        else:
+            self.run_in(self.update_power_status, 0)
+            self.run_in(self.update_aux_status, 0)
         self.run_every(self.publish_measurements, "now", 4)
-        self.run_every(self.scheduler, "now", 4)
+        self.run_every(self.scheduler, "now", self.scheduler_interval)
+
+        # fire "dump_trace" (optionally with name, path and last) to dump the Modbus trace of the inverter
+        self.listen_event(self.dump_trace, "dump_trace")
+
+    def terminate(self):
+        self.power_history.close()
+
+    def flush_power_history(self, kwargs):
+        self.power_history.flush()
 
     def scheduler_remote_on(self, entity, attribute, old, new, kwargs):
         self.scheduler_status["user_override"] = "active_local"
+        self.run_in(self.scheduler, 0)
 
     def scheduler_remote_off(self, entity, attribute, old, new, kwargs):
         self.scheduler_status["user_override"] = "to_inactive"
+        self.run_in(self.scheduler, 0)
 
     def scheduler(self, kwargs):
+        if not self.scheduler_lock.acquire(blocking = False):
+            # a run is in progress and does the same
+            return
+        try:
+            self.run_scheduler()
+        finally:
+            self.scheduler_lock.release()
+
+    def run_scheduler(self):
 
         if self.scheduler_status["user_override"] is not None:
             self.scheduler_status["state"] = self.scheduler_status["user_override"]
             self.scheduler_status["user_override"] = None
                     
-        if self.scheduler_status["state"] == "to_inactive":
-            self.scheduler_status["state"] = "inactive"
-            self.sofar_inverter.set_battery_power_charge_kW(0.0)
-            self.sofar_inverter.set_local()
+        # a failed write leaves the state untouched so that the transition is retried on the next tick
+        try:
+            if self.scheduler_status["state"] == "to_inactive":
+                self.sofar_inverter.set_battery_power_charge_kW(0.0)
+                self.sofar_inverter.set_local()
+                self.scheduler_status["state"] = "inactive"
             
-        elif self.scheduler_status["state"] == "active_local":
-            self.sofar_inverter.set_local()
-            if self.sofar_inverter.power_status["battery_power_charge_kW"] > self.scheduler_params["battery_charge_power_max_kW"] + 0.1 and self.sofar_inverter.battery_status["soc"] < self.scheduler_params["battery_scheduler_soc_max"]:
-                self.scheduler_status["state"] = "active_remote_charge_power_charge_limit"
+            elif self.scheduler_status["state"] == "active_local":
+                self.sofar_inverter.set_local()
+                if self.sofar_inverter.power_status["battery_power_charge_kW"] > self.scheduler_params["battery_charge_power_max_kW"] + 0.1 and self.sofar_inverter.battery_status["soc"] < self.scheduler_params["battery_scheduler_soc_max"]:
+                    self.scheduler_status["state"] = "active_remote_charge_power_charge_limit"
                 
-        elif self.scheduler_status["state"] == "active_remote_charge_power_charge_limit":
-            self.sofar_inverter.set_remote()
-            self.sofar_inverter.set_battery_power_charge_kW(self.scheduler_params["battery_charge_power_max_kW"])            
+            elif self.scheduler_status["state"] == "active_remote_charge_power_charge_limit":
+                self.sofar_inverter.set_remote_battery_power_charge_kW(self.scheduler_params["battery_charge_power_max_kW"],
+                                                                      timeout = self.scheduler_params["remote_timeout"])
 
-            if self.global_status["grid_power_kW"] < 0.0 or self.sofar_inverter.battery_status["soc"] >= self.scheduler_params["battery_scheduler_soc_max"]:
-                self.scheduler_status["state"] = "active_local"
+                if self.global_status["grid_power_kW"] < 0.0 or self.sofar_inverter.battery_status["soc"] >= self.scheduler_params["battery_scheduler_soc_max"]:
+                    self.scheduler_status["state"] = "active_local"
             
-        elif self.scheduler_status["state"] == "inactive":
-            pass
+            elif self.scheduler_status["state"] == "inactive":
+                pass
         
+        except (TimeoutError, ConnectionError) as e:
+            print("{}: Sofar control write failed: {}".format(timeutils.get_current_timestamp(), e))
+
         self.publish_message("scheduler_status", "scheduler_status", self.scheduler_status["state"])
                         
-    def update_global_status(self):
+    def publish_power_history(self, kwargs):
+        # rolling figures over the stored power samples, no HA history needed
+        history = self.power_history
+        max_gap = self.power_history_max_gap
+        end = time.time()
+        start = end - 86400
+        query_start = time.monotonic()
 
-        hoymiles_inverter_power_status = {
-            "inverter_0_power_kW": self.read_measurement("hoymiles_inverter_0_power"),
-            "inverter_1_power_kW": self.read_measurement("hoymiles_inverter_1_power")
+        attributes = {
+            "friendly_name": "Produzierte Energie letzte 24 h",
+            "unit_of_measurement": "kWh",
+            "device_class": "energy",
+            "load_energy_kwh": self.disp_format(history.integral("load_power_kW", start, end, max_gap = max_gap)),
+            "sold_energy_kwh": self.disp_format(history.integral("grid_power_kW", start, end, lower = 0.0, max_gap = max_gap)),
+            "bought_energy_kwh": self.disp_format(abs(history.integral("grid_power_kW", start, end, upper = 0.0, max_gap = max_gap))),
+            "pv_power_max_kw": history.max("pv_power_kW", start, end),
+            "load_power_max_kw": history.max("load_power_kW", start, end),
+            "load_power_p95_kw": history.percentile("load_power_kW", 95, start, end),
+            "samples": len(history.window([], start, end)[0])
         }
+        pv_energy_kwh = self.disp_format(history.integral("pv_power_kW", start, end, max_gap = max_gap))
+        attributes["query_time_ms"] = round(1000 * (time.monotonic() - query_start), 1)
+
+        self.set_state("sensor.power_history_24h", state = pv_energy_kwh, attributes = attributes)
+
+    def update_global_status(self):
+
+        # sum over all Hoymiles inverters, published by hoymiles_mgr
+        hoymiles_power_kW = self.read_measurement("hoymiles_total_power")
         
         self.global_status["grid_power_kW"] = self.sofar_inverter.power_status["grid_power_kW"]        
-        self.global_status["pv_power_kW"] = self.sofar_inverter.power_status["pv_power_kW"] + hoymiles_inverter_power_status["inverter_0_power_kW"] + hoymiles_inverter_power_status["inverter_1_power_kW"]
-        self.global_status["load_power_kW"] = hoymiles_inverter_power_status["inverter_0_power_kW"] + hoymiles_inverter_power_status["inverter_1_power_kW"] + self.sofar_inverter.power_status["inverter_power_kW"] - self.global_status["grid_power_kW"]
+        self.global_status["pv_power_kW"] = self.sofar_inverter.power_status["pv_power_kW"] + hoymiles_power_kW
+        self.global_status["load_power_kW"] = hoymiles_power_kW + self.sofar_inverter.power_status["inverter_power_kW"] - self.global_status["grid_power_kW"]
         self.global_status["last_updated"] = self.sofar_inverter.power_status["last_updated"]
         
+    # polls that fail or are shed by the circuit breaker keep the previous values; the
+    # breaker state and retry counters are published with the diagnosis measurements
+
     def update_power_status(self, kwargs):
         
-        self.sofar_inverter.update_power_status()
-        self.update_global_status()
+        try:
+            self.sofar_inverter.update_power_status()
+            self.update_global_status()
+            self.update_cadence()
+            power_update = self.get_power_update()
+            self.power_history.append(power_update["timestamp"], power_update)
+            self.fire_event("sofar_power_update", **power_update)
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.run_in(self.update_power_status, self.power_poll_interval())
+
+        self.scheduler(kwargs)
 
     def update_aux_status(self, kwargs):
         
-        self.sofar_inverter.update_battery_status()
-        self.sofar_inverter.update_inverter_status()
-        self.sofar_inverter.update_temperature_status()
+        try:
+            self.sofar_inverter.update_aux_status()
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.run_in(self.update_aux_status, self.aux_cadence.interval)
+
+    async def update_power_status_async(self, kwargs):
+
+        try:
+            await self.sofar_inverter.update_power_status_async()
+            await self.run_in_executor(self.update_global_status)
+            self.update_cadence()
+            power_update = self.get_power_update()
+            self.power_history.append(power_update["timestamp"], power_update)
+            await self.fire_event("sofar_power_update", **power_update)
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            await self.run_in(self.update_power_status_async, self.power_poll_interval())
+
+        await self.run_in_executor(self.scheduler, kwargs)
+
+    async def update_aux_status_async(self, kwargs):
+
+        try:
+            await self.sofar_inverter.update_aux_status_async()
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            await self.run_in(self.update_aux_status_async, self.aux_cadence.interval)
+
+    def get_power_update(self):
+        # consumed by the export limiter in hoymiles_mgr and the energy integration in statistic_mgr;
+        # the timestamp (taken right after the poll) allows measuring the loop latency and the sample spacing
+        return {
+            "grid_power_kW": self.global_status["grid_power_kW"],
+            "pv_power_kW": self.global_status["pv_power_kW"],
+            "load_power_kW": self.global_status["load_power_kW"],
+            "battery_power_charge_kW": self.sofar_inverter.power_status["battery_power_charge_kW"],
+            "timestamp": time.time()
+        }
+
+    def power_poll_interval(self):
+        if self.fast_poll_above_grid_power_kW is not None and self.global_status["grid_power_kW"] > self.fast_poll_above_grid_power_kW:
+            return self.power_cadence.min_interval
+        return self.power_cadence.interval
+
+    def dump_trace(self, event_name, data, kwargs):
+        tracer = self.sofar_inverter.tracer
+        if data.get("name") in (None, tracer.name):
+            tracing.dump(names = [tracer.name], path = data.get("path"), last = data.get("last"))
+
+    def update_cadence(self):
+
+        signals = {
+            "grid_power_kW": self.global_status["grid_power_kW"],
+            "pv_power_kW": self.global_status["pv_power_kW"],
+            "battery_power_charge_kW": self.sofar_inverter.power_status["battery_power_charge_kW"]
+        }
+
+        self.power_cadence.update(signals)
+        self.aux_cadence.update(signals)
         
     def publish_measurements(self, kwargs):
         
@@ -110,6 +282,42 @@ class SolarMgr(hass.Hass):
                                  friendly_name = "sofar_battery_latency",
                                  value = self.sofar_inverter.battery_status["latency_ms"],
                                  unit = "ms",
+                                 meas_type = "power")
+
+        self.publish_measurement(var_name = "solar_power_poll_interval",
+                                 friendly_name = "solar_power_poll_interval",
+                                 value = self.disp_format(self.power_poll_interval()),
+                                 unit = "s",
+                                 meas_type = "duration")
+
+        self.publish_measurement(var_name = "solar_aux_poll_interval",
+                                 friendly_name = "solar_aux_poll_interval",
+                                 value = self.disp_format(self.aux_cadence.interval),
+                                 unit = "s",
+                                 meas_type = "duration")
+
+        io_status = self.sofar_inverter.get_io_status()
+
+        self.publish_message(var_name = "sofar_breaker_state",
+                             friendly_name = "sofar_breaker_state",
+                             msg_text = io_status["state"])
+
+        self.publish_measurement(var_name = "sofar_retry_count",
+                                 friendly_name = "sofar_retry_count",
+                                 value = io_status["retry_count"],
+                                 unit = "retries",
+                                 meas_type = "power")
+
+        self.publish_measurement(var_name = "sofar_failure_count",
+                                 friendly_name = "sofar_failure_count",
+                                 value = io_status["failure_count"],
+                                 unit = "calls",
+                                 meas_type = "power")
+
+        self.publish_measurement(var_name = "sofar_shed_count",
+                                 friendly_name = "sofar_shed_count",
+                                 value = io_status["shed_count"],
+                                 unit = "calls",
                                  meas_type = "power")        
         
     def publish_measurements_global(self):
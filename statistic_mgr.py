@@ -1,35 +1,78 @@
 import appdaemon.plugins.hass.hassapi as hass
+from journal import StateJournal
 import os, configparser, datetime, calendar, time
 
+GAP_POLICIES = ("skip", "hold", "linear")
+
 class AccumulatingStatistic:
 
-    def __init__(self, name, accumulator_names, data_namespace):
+    def __init__(self, name, accumulator_names, data_namespace, journal, max_gap = 60.0, gap_policy = "skip"):
+        if gap_policy not in GAP_POLICIES:
+            raise ValueError(f"Gap policy '{gap_policy}' not available")
+
         self.data_namespace = data_namespace
+        self.journal = journal
         self.accumulator_names = accumulator_names
         self.name = name.lower()
+
+        # samples further apart than max_gap seconds (failed polls, restarts) are integrated according to
+        # gap_policy: skip adds nothing for the gap, hold keeps the earlier value, linear interpolates
+        self.max_gap = max_gap
+        self.gap_policy = gap_policy
         
         self.last_value = 0.0
+        self.last_time = None
         self.accumulators = {name: 0.0 for name in self.accumulator_names}
 
-        self._load_state()    
+        self.num_samples = 0
+        self.num_duplicates = 0
+        self.num_gaps = 0
 
     def get_accumulator(self, name):
         return self.accumulators.get(name, 0.0)
 
     def reset_accumulator(self, name):
         self.accumulators[name] = 0.0
+        self.journal.set(f"{self.name}_accumulator_{name}", 0.0)
                 
-    def accumulate(self, value, delta_T):
-        increment = 0.5 * (self.last_value + value) * delta_T
+    def add_sample(self, value, timestamp):
+        # value in kW, timestamp in seconds; trapezoidal integration over the actual spacing of the samples
+        if self.last_time is not None and timestamp <= self.last_time:
+            # repeated or out-of-order sample
+            self.num_duplicates += 1
+            return False
+
+        increment = 0.0
+        if self.last_time is not None:
+            dt_hr = (timestamp - self.last_time) / 3600.0
+            if timestamp - self.last_time <= self.max_gap or self.gap_policy == "linear":
+                increment = 0.5 * (self.last_value + value) * dt_hr
+            elif self.gap_policy == "hold":
+                increment = self.last_value * dt_hr
+
+            if timestamp - self.last_time > self.max_gap:
+                self.num_gaps += 1
+
         self.last_value = value
+        self.last_time = timestamp
+        self.num_samples += 1
         
         for key in self.accumulator_names:
             self.accumulators[key] += increment
 
         self._dump_state()
+        return True
             
     def _dump_state(self):
 
+        # persisted in the local journal only; StatisticMgr flushes it and publishes the state to HA on its own schedule
+        self.journal.set(f"{self.name}_last_value", self.last_value)
+        self.journal.set(f"{self.name}_last_time", self.last_time)
+        for key, value in self.accumulators.items():
+            self.journal.set(f"{self.name}_accumulator_{key}", value)
+
+    def publish_state(self):
+
         self.data_namespace.publish_measurement(var_name = f"accumulating_statistic_{self.name}_last_value",
                                                 friendly_name = f"accumulating_statistic_{self.name}_last_value",
                                                 value = self.last_value,
@@ -43,29 +86,72 @@ class AccumulatingStatistic:
                                                     unit = "kWh",
                                                     meas_type = "power")
 
-    def _load_state(self):
-               
-        self.last_value = self.data_namespace.get_last_from_history(f"sensor.accumulating_statistic_{self.name}_last_value")
+    def state_entities(self):
+        # journal keys of the persisted state and the HA entities it is published as
+        entities = {f"{self.name}_last_value": f"sensor.accumulating_statistic_{self.name}_last_value"}
+        for key in self.accumulator_names:
+            entities[f"{self.name}_accumulator_{key}"] = f"sensor.accumulating_statistic_{self.name}_accumulator_{key}"
+        return entities
+
+    def load_state(self, state):
 
+        # the time of the last sample is only kept in the journal; without it, the first sample starts afresh
+        self.last_time = self.journal.get(f"{self.name}_last_time")
+        self.last_value = state[f"{self.name}_last_value"]
         for key in self.accumulator_names:
-            self.accumulators[key] = self.data_namespace.get_last_from_history(f"sensor.accumulating_statistic_{self.name}_accumulator_{key}")
+            self.accumulators[key] = state[f"{self.name}_accumulator_{key}"]
+
+        # state restored from HA is journaled from now on
+        self._dump_state()
             
 class StatisticMgr(hass.Hass):
 
     def initialize(self):
 
         self.accumulator_names = ["hourly", "daily", "monthly"]
-        self.run_in(self.schedule_callbacks, 30)
+
+        # the accumulator state goes to a local journal, fsynced every journal_flush_interval seconds (which bounds
+        # what a crash can lose); the copy in HA is only refreshed every state_publish_interval seconds
+        self.journal = StateJournal(self.args.get("journal_path", os.path.join(os.path.dirname(os.path.abspath(__file__)), "statistic_journal.log")),
+                                    compact_after = self.args.get("journal_compact_after", 1000))
+        self.journal_flush_interval = self.args.get("journal_flush_interval", 10)
+        self.state_publish_interval = self.args.get("state_publish_interval", 300)
+        self.max_gap = self.args.get("integration_max_gap", 60)
+        self.gap_policy = self.args.get("integration_gap_policy", "skip")
+        self.global_stats = {}
+
+        # HA is only asked for the state the journal does not have, with one query for all entities
+        self.startup_time = time.monotonic()
+        self.restore_sources = {}
+
+        startup_delay = 0 if len(self.journal.values) > 0 else self.args.get("startup_delay", 30)
+        self.run_in(self.schedule_callbacks, startup_delay)
+
+    def terminate(self):
+        self.journal.flush()
 
     def schedule_callbacks(self, kwargs):
 
+        restore_start = time.monotonic()
         self.global_stats = {
-            "energy_produced_kwh": AccumulatingStatistic("energy_produced_kwh", self.accumulator_names, data_namespace = self),
-            "energy_sold_kwh": AccumulatingStatistic("energy_sold_kwh", self.accumulator_names, data_namespace = self),
-            "energy_bought_kwh": AccumulatingStatistic("energy_bought_kwh", self.accumulator_names, data_namespace = self),
-            "energy_used_kwh": AccumulatingStatistic("energy_used_kwh", self.accumulator_names, data_namespace = self)
+            "energy_produced_kwh": AccumulatingStatistic("energy_produced_kwh", self.accumulator_names, data_namespace = self, journal = self.journal,
+                                                         max_gap = self.max_gap, gap_policy = self.gap_policy),
+            "energy_sold_kwh": AccumulatingStatistic("energy_sold_kwh", self.accumulator_names, data_namespace = self, journal = self.journal,
+                                                         max_gap = self.max_gap, gap_policy = self.gap_policy),
+            "energy_bought_kwh": AccumulatingStatistic("energy_bought_kwh", self.accumulator_names, data_namespace = self, journal = self.journal,
+                                                         max_gap = self.max_gap, gap_policy = self.gap_policy),
+            "energy_used_kwh": AccumulatingStatistic("energy_used_kwh", self.accumulator_names, data_namespace = self, journal = self.journal,
+                                                         max_gap = self.max_gap, gap_policy = self.gap_policy)
         }
 
+        entities = {}
+        for stat in self.global_stats.values():
+            entities.update(stat.state_entities())
+        state = self.restore_state(entities)
+        for stat in self.global_stats.values():
+            stat.load_state(state)
+        self.publish_startup_time(restore_start)
+
         self.friendly_names = {
             "energy_produced_kwh": "Produzierte Energie",
             "energy_sold_kwh": "Verkaufte Energie",
@@ -73,24 +159,43 @@ class StatisticMgr(hass.Hass):
             "energy_used_kwh": "Verbrauchte Energie",
         }
         
-        self.integration_interval_sec = 4.0    
-        self.run_every(self.update_statistics, "now", self.integration_interval_sec)
-        self.run_every(self.publish_measurements, "now", self.integration_interval_sec)
+        # energy is integrated from the power samples solar_mgr sends after every poll, with their own timestamps
+        self.listen_event(self.update_statistics, "sofar_power_update")
+
+        self.publish_interval_sec = 4.0
+        self.run_every(self.publish_measurements, "now", self.publish_interval_sec)
+        self.run_every(self.flush_journal, "now", self.journal_flush_interval)
+        self.run_every(self.publish_statistic_states, "now", self.state_publish_interval)
         self.run_hourly(self.make_and_publish_snapshots_hourly, datetime.time(0, 0, 0))
         self.run_daily(self.make_and_publish_snapshots_daily, datetime.time(23, 59, 59))
         self.run_daily(self.make_and_publish_snapshots_monthly, datetime.time(23, 59, 59))
         
-    def update_statistics(self, kwargs):
+    def update_statistics(self, event_name, data, kwargs):
+
+        timestamp = data["timestamp"]
+        self.global_stats["energy_produced_kwh"].add_sample(abs(data["pv_power_kW"]), timestamp)
+        self.global_stats["energy_used_kwh"].add_sample(abs(data["load_power_kW"]), timestamp)
+
+        # both directions are sampled every time, so that each integral sees the zero crossings
+        grid_power = data["grid_power_kW"]
+        self.global_stats["energy_sold_kwh"].add_sample(max(grid_power, 0.0), timestamp)
+        self.global_stats["energy_bought_kwh"].add_sample(max(-grid_power, 0.0), timestamp)
 
-        sampling_interval_hr = self.integration_interval_sec / 3600.0
-        self.global_stats["energy_produced_kwh"].accumulate(abs(self.read_measurement("global_pv_power")), sampling_interval_hr)
-        self.global_stats["energy_used_kwh"].accumulate(abs(self.read_measurement("global_load_power")), sampling_interval_hr)
+    def flush_journal(self, kwargs):
+        self.journal.flush()
 
-        grid_power = self.read_measurement("global_grid_power")
-        if grid_power > 0.0:
-            self.global_stats["energy_sold_kwh"].accumulate(abs(grid_power), sampling_interval_hr)
-        else:
-            self.global_stats["energy_bought_kwh"].accumulate(abs(grid_power), sampling_interval_hr)
+    def publish_statistic_states(self, kwargs):
+        for stat in self.global_stats.values():
+            stat.publish_state()
+
+        stat = self.global_stats["energy_produced_kwh"]
+        self.set_state("sensor.statistic_mgr_integration_gaps",
+                       state = stat.num_gaps,
+                       attributes = {"friendly_name": "Lücken Energieintegration",
+                                     "samples": stat.num_samples,
+                                     "duplicates": stat.num_duplicates,
+                                     "max_gap": self.max_gap,
+                                     "gap_policy": self.gap_policy})
 
     def make_and_publish_snapshots_hourly(self, kwargs):
         self.publish_as_statistic("hourly", reset_accumulator = True)
@@ -140,15 +245,72 @@ class StatisticMgr(hass.Hass):
             if reset_accumulator:
                 stat.reset_accumulator(accumulator_name)
 
-    def get_last_from_history(self, name):
+    def restore_state(self, entities):
+        # per journal key: the journal, else the entity's current state in HA, else its last valid state
+        # in the history of the last day, else 0; HA is asked at most once for all current states and
+        # once for the history of all entities still missing
+        state = {key: self.journal.get(key) for key in entities}
+        self.count_restored(state, "journal")
+
+        missing = [key for key, value in state.items() if value is None]
+        if missing:
+            ha_states = self.get_state() or {}
+            state.update({key: self.parse_state(ha_states.get(entities[key], {}).get("state")) for key in missing})
+            self.count_restored({key: state[key] for key in missing}, "states")
+
+        missing = [key for key, value in state.items() if value is None]
+        if missing:
+            history = self.get_last_from_history([entities[key] for key in missing])
+            state.update({key: history.get(entities[key]) for key in missing})
+            self.count_restored({key: state[key] for key in missing}, "history")
+
+        for key, value in state.items():
+            if value is None:
+                print(f"No stored state for {entities[key]}, starting from 0.")
+                state[key] = 0.0
+                self.restore_sources["none"] = self.restore_sources.get("none", 0) + 1
+
+        return state
+
+    def count_restored(self, state, source):
+        num_restored = sum(value is not None for value in state.values())
+        if num_restored > 0:
+            self.restore_sources[source] = self.restore_sources.get(source, 0) + num_restored
+
+    def publish_startup_time(self, restore_start):
+        restore_time_ms = 1000 * (time.monotonic() - restore_start)
+        startup_time_ms = 1000 * (time.monotonic() - self.startup_time)
+        print(f"StatisticMgr state restored in {restore_time_ms:.0f} ms ({self.restore_sources}), started after {startup_time_ms:.0f} ms.")
+
+        self.set_state("sensor.statistic_mgr_startup_time",
+                       state = round(startup_time_ms),
+                       attributes = {"friendly_name": "Startzeit Statistik",
+                                     "unit_of_measurement": "ms",
+                                     "device_class": "duration",
+                                     "restore_time_ms": round(restore_time_ms),
+                                     "restore_sources": self.restore_sources})
+
+    def parse_state(self, raw_value):
+        # None for missing, "unknown" and "unavailable" states
+        try:
+            return float(raw_value)
+        except (TypeError, ValueError):
+            return None
+
+    def get_last_from_history(self, entity_ids):
+        # last valid state of each entity over the last day, in one history query for all of them
         start_time = datetime.datetime.now() - datetime.timedelta(days = 1)
-        data = self.get_history(entity_id = name, start_time = start_time)[0]
-        return float(data[-1]["state"])
+        history = self.get_history(entity_id = ",".join(entity_ids), start_time = start_time) or []
+
+        last_values = {}
+        for entity_history in history:
+            for entry in reversed(entity_history):
+                value = self.parse_state(entry.get("state"))
+                if value is not None:
+                    last_values[entry["entity_id"]] = value
+                    break
+        return last_values
     
-    def read_measurement(self, name):
-        raw_value = self.get_entity(f"sensor.{name}").get_state(attribute = "state")
-        return float(raw_value) if raw_value else 0.0
-                
     def publish_statistic(self, var_name, friendly_name, value, unit, meas_type, state_class):
         self.set_state(f"statistic.{var_name}",
                        state = value,
@@ -0,0 +1,174 @@
+import bisect, math, mmap, os, struct, threading
+
+try:
+    import numpy as np
+except ImportError:
+    # queries fall back to plain python loops, which take tens of ms over a day of samples instead of a few ms
+    np = None
+
+# file layout: header, then the timestamp column (float64) and one float32 column per channel,
+# each with one slot per sample; the header's sample count tells where the ring continues
+HEADER = struct.Struct("<8sIIQ")
+MAGIC = b"TSSTORE1"
+
+class TimeSeriesStore:
+
+    def __init__(self, channels, capacity, path = None):
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.channel_offset = HEADER.size + 8 * capacity
+        size = self.channel_offset + 4 * capacity * len(self.channels)
+
+        # with a path the columns live in a memory-mapped file and survive restarts, otherwise in memory
+        self.file = None
+        if path is None:
+            self.buffer = bytearray(size)
+        else:
+            self.buffer = self._map_file(path, size)
+
+        magic, stored_capacity, stored_channels, self.num_samples = HEADER.unpack_from(self.buffer, 0)
+        if (magic, stored_capacity, stored_channels) != (MAGIC, capacity, len(self.channels)):
+            if magic == MAGIC:
+                print(f"Time series {path} has a different layout, starting afresh.")
+            self.num_samples = 0
+            HEADER.pack_into(self.buffer, 0, MAGIC, self.capacity, len(self.channels), 0)
+
+        self.view = memoryview(self.buffer)
+        self.timestamps = self.view[HEADER.size : self.channel_offset].cast("d")
+        self.columns = {channel: self.view[self.channel_offset + 4 * capacity * index : self.channel_offset + 4 * capacity * (index + 1)].cast("f")
+                        for index, channel in enumerate(self.channels)}
+
+    def _map_file(self, path, size):
+        exists = os.path.isfile(path) and os.path.getsize(path) == size
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(size)
+        return mmap.mmap(self.file.fileno(), size)
+
+    def __len__(self):
+        return min(self.num_samples, self.capacity)
+
+    def append(self, timestamp, values):
+        # values maps channels to values, missing channels are stored as NaN; samples must be newer than the last one
+        with self.lock:
+            if self.num_samples > 0 and timestamp <= self.timestamps[(self.num_samples - 1) % self.capacity]:
+                return False
+
+            slot = self.num_samples % self.capacity
+            self.timestamps[slot] = timestamp
+            for channel, column in self.columns.items():
+                column[slot] = values.get(channel, math.nan)
+
+            self.num_samples += 1
+            struct.pack_into("<Q", self.buffer, HEADER.size - 8, self.num_samples)
+            return True
+
+    def flush(self):
+        if self.file is not None:
+            self.buffer.flush()
+
+    def close(self):
+        if self.file is not None:
+            # the mapping can only be closed once no views into it are left
+            for column in [self.timestamps] + list(self.columns.values()):
+                column.release()
+            self.view.release()
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+    def window(self, channels, start = None, end = None):
+        # copies of the timestamps and the given channels between start and end (inclusive), oldest first
+        with self.lock:
+            num_stored = len(self)
+            first = (self.num_samples - num_stored) % self.capacity
+            segments = [(first, min(first + num_stored, self.capacity)), (0, max(0, first + num_stored - self.capacity))]
+
+            if np is not None:
+                timestamps = np.concatenate([np.frombuffer(self.timestamps, dtype = np.float64)[a:b] for a, b in segments])
+                columns = {channel: np.concatenate([np.frombuffer(self.columns[channel], dtype = np.float32)[a:b] for a, b in segments]).astype(np.float64)
+                           for channel in channels}
+            else:
+                timestamps = [timestamp for a, b in segments for timestamp in self.timestamps[a:b]]
+                columns = {channel: [value for a, b in segments for value in self.columns[channel][a:b]] for channel in channels}
+
+        # timestamps are increasing, so the window is found by bisection
+        low = 0 if start is None else _bisect(timestamps, start, left = True)
+        high = len(timestamps) if end is None else _bisect(timestamps, end, left = False)
+        return timestamps[low:high], {channel: column[low:high] for channel, column in columns.items()}
+
+    def integral(self, channel, start = None, end = None, lower = None, upper = None, max_gap = None):
+        # trapezoidal integral over the window in value-hours (kWh for kW), after clipping to [lower, upper];
+        # NaN samples count as 0, and intervals longer than max_gap seconds (outages, restarts) add nothing
+        timestamps, columns = self.window([channel], start, end)
+        values = columns[channel]
+
+        if np is not None:
+            values = np.clip(np.nan_to_num(values), lower, upper) if lower is not None or upper is not None else np.nan_to_num(values)
+            dt = np.diff(timestamps)
+            if max_gap is not None:
+                dt[dt > max_gap] = 0.0
+            return float(np.sum(0.5 * (values[1:] + values[:-1]) * dt)) / 3600.0
+
+        values = [_clip(0.0 if math.isnan(value) else value, lower, upper) for value in values]
+        return sum(0.5 * (values[i] + values[i - 1]) * (timestamps[i] - timestamps[i - 1]) for i in range(1, len(values))
+                   if max_gap is None or timestamps[i] - timestamps[i - 1] <= max_gap) / 3600.0
+
+    def sum(self, channel, start = None, end = None):
+        values = self._valid_values(channel, start, end)
+        return float(np.sum(values)) if np is not None else sum(values)
+
+    def mean(self, channel, start = None, end = None):
+        values = self._valid_values(channel, start, end)
+        if len(values) == 0:
+            return None
+        return float(np.mean(values)) if np is not None else sum(values) / len(values)
+
+    def min(self, channel, start = None, end = None):
+        values = self._valid_values(channel, start, end)
+        if len(values) == 0:
+            return None
+        return float(np.min(values)) if np is not None else min(values)
+
+    def max(self, channel, start = None, end = None):
+        values = self._valid_values(channel, start, end)
+        if len(values) == 0:
+            return None
+        return float(np.max(values)) if np is not None else max(values)
+
+    def percentile(self, channel, q, start = None, end = None):
+        # q in percent, linear interpolation between the closest ranks
+        values = self._valid_values(channel, start, end)
+        if len(values) == 0:
+            return None
+        if np is not None:
+            return float(np.percentile(values, q))
+
+        values = sorted(values)
+        rank = q / 100.0 * (len(values) - 1)
+        low = int(rank)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (rank - low) * (values[high] - values[low])
+
+    def _valid_values(self, channel, start, end):
+        timestamps, columns = self.window([channel], start, end)
+        values = columns[channel]
+        if np is not None:
+            return values[~np.isnan(values)]
+        return [value for value in values if not math.isnan(value)]
+
+def _bisect(timestamps, timestamp, left):
+    if np is not None:
+        return int(np.searchsorted(timestamps, timestamp, side = "left" if left else "right"))
+    return bisect.bisect_left(timestamps, timestamp) if left else bisect.bisect_right(timestamps, timestamp)
+
+def _clip(value, lower, upper):
+    if lower is not None:
+        value = max(lower, value)
+    if upper is not None:
+        value = min(upper, value)
+    return value
@@ -0,0 +1,87 @@
+import itertools, struct, time
+
+TX = 0
+RX = 1
+ERROR = 2
+RX_INVALID = 3
+
+KIND_LABELS = {TX: "TX", RX: "RX", ERROR: "!!", RX_INVALID: "RX?"}
+
+# slot layout: <sequence number> <monotonic time> <kind> <original length> <stored length> <data>
+SLOT_HEADER = struct.Struct(">QdBHH")
+
+class FrameTracer:
+
+    def __init__(self, name, num_slots = 1024, max_frame_len = 272):
+        self.name = name
+        self.num_slots = num_slots
+        self.max_frame_len = max_frame_len
+        self.slot_size = SLOT_HEADER.size + max_frame_len
+
+        # frames go into fixed-size slots of one preallocated buffer, longer frames are truncated;
+        # nothing is formatted until the trace is dumped
+        self.buffer = bytearray(num_slots * self.slot_size)
+        self.view = memoryview(self.buffer)
+
+        # next() on a count is atomic, so threads and the event loop can record without a lock
+        self.sequence = itertools.count(1)
+
+    def record(self, kind, frame):
+        sequence = next(self.sequence)
+        offset = (sequence % self.num_slots) * self.slot_size
+        stored = min(len(frame), self.max_frame_len)
+
+        SLOT_HEADER.pack_into(self.buffer, offset, sequence, time.monotonic(), kind, len(frame), stored)
+        data_offset = offset + SLOT_HEADER.size
+        self.view[data_offset : data_offset + stored] = frame[:stored]
+
+    def record_error(self, message):
+        self.record(ERROR, message.encode("utf-8", "replace"))
+
+    def entries(self):
+        # (sequence, time, kind, original length, data) of the recorded frames, oldest first
+        entries = []
+        for offset in range(0, len(self.buffer), self.slot_size):
+            sequence, timestamp, kind, length, stored = SLOT_HEADER.unpack_from(self.buffer, offset)
+            if sequence > 0:
+                data_offset = offset + SLOT_HEADER.size
+                entries.append((sequence, timestamp, kind, length, bytes(self.buffer[data_offset : data_offset + stored])))
+        return sorted(entries)
+
+    def format(self, last = None):
+        entries = self.entries()
+        if last is not None:
+            entries = entries[-last:]
+        if len(entries) == 0:
+            return f"{self.name}: trace empty"
+
+        now = time.monotonic()
+        lines = [f"{self.name}: last {len(entries)} frames"]
+        for sequence, timestamp, kind, length, data in entries:
+            if kind == ERROR:
+                text = data.decode("utf-8", "replace")
+            else:
+                text = data.hex(" ") + (f" ... ({length} bytes)" if length > len(data) else "")
+            lines.append(f"  {timestamp - now:+11.6f} s {KIND_LABELS.get(kind, '??')} {text}")
+        return "\n".join(lines)
+
+    def clear(self):
+        self.buffer[:] = bytes(len(self.buffer))
+
+# tracers are shared by name, so that the apps can dump the traces of their devices
+TRACERS = {}
+
+def get_tracer(name, **kwargs):
+    if name not in TRACERS:
+        TRACERS[name] = FrameTracer(name, **kwargs)
+    return TRACERS[name]
+
+def dump(names = None, path = None, last = None):
+    text = "\n".join(tracer.format(last) for name, tracer in sorted(TRACERS.items()) if names is None or name in names)
+
+    if path is None:
+        print(text)
+    else:
+        with open(path, "a") as trace_file:
+            trace_file.write(text + "\n")
+    return text